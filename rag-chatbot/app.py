@@ -1,23 +1,77 @@
 # app.py
 
 import os
-import re
-from typing import Any, Dict, List
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
 
 import streamlit as st
 from dotenv import load_dotenv
 from langfuse.langchain import CallbackHandler as LangfuseCallbackHandler
 
 from prompts import MODE_INSTR, PERSONA_MAP  # optional, for future UI use
-from rag_tools import summarize_uploaded_papers, llm_complete
-from graph_config import AppState, rag_graph
+from rag_common import _clean_text, init_session_state, llm_complete
+from rag_tools import (
+    SummaryCache,
+    submit_async,
+    summarize_uploaded_papers,
+    warm_embedding_model,
+)
+from graph_config import AppState, canonical_paper_summaries, rag_graph
 from proposal_graph_config import ProposalState, proposal_graph #anna
 
 # -------- env + Langfuse -------- #
 
 load_dotenv()
 
-LANGFUSE_HANDLER = LangfuseCallbackHandler()
+# how many past turns are passed verbatim to the graphs as [Recent Q&A];
+# anything older only survives through the running session summary
+MAX_RECENT_TURNS = int(os.getenv("MAX_RECENT_TURNS", "6"))
+# the running summary is refreshed after this many new turns, or sooner when
+# a single exchange is longer than SUMMARY_MIN_TURN_CHARS
+SUMMARY_MIN_NEW_TURNS = int(os.getenv("SUMMARY_MIN_NEW_TURNS", "4"))
+SUMMARY_MIN_TURN_CHARS = int(os.getenv("SUMMARY_MIN_TURN_CHARS", "1500"))
+
+# sidebar choices; the index maps are looked up on every rerun
+MODES = ["Research question helper", "Proposal refinement assistant"]
+MODE_INDEX = {m: i for i, m in enumerate(MODES)}
+PERSONAS = ["Supervisor", "Helper", "Creative"]
+PERSONA_INDEX = {p: i for i, p in enumerate(PERSONAS)}
+
+
+@st.cache_resource(show_spinner=False)
+def get_langfuse_handler() -> LangfuseCallbackHandler:
+    # One handler per process instead of one per Streamlit rerun.
+    # The Langfuse 3.x handler implements the async callback hooks as well,
+    # so the same instance is used for graph.ainvoke().
+    return LangfuseCallbackHandler()
+
+
+@st.cache_resource(show_spinner=False)
+def get_summary_executor() -> ThreadPoolExecutor:
+    # Memory summaries run off the script thread, shared by all sessions.
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+
+@st.cache_resource(show_spinner=False)
+def get_paper_summary_cache() -> SummaryCache:
+    # Paper summaries keyed by content hash, shared across sessions.
+    return SummaryCache(os.getenv("SUMMARY_CACHE_DIR", "/tmp/proposify_sum"))
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_embeddings():
+    # Once per process: load the embedding model while the first page renders.
+    # Own daemon thread, so a slow model pull never holds a summary worker.
+    thread = threading.Thread(
+        target=warm_embedding_model, name="embed-warmup", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+warm_up_embeddings()
 
 # -------- Streamlit setup -------- #
 
@@ -30,58 +84,42 @@ with col2:
 
 # -------- session state -------- #
 
-if "history" not in st.session_state:
-    st.session_state.history: List[Dict[str, Any]] = []
-if "summary" not in st.session_state:
-    st.session_state.summary = ""
-if "recent_sources" not in st.session_state:
-    st.session_state.recent_sources = []
-if "mode" not in st.session_state:
-    st.session_state.mode = "Research question helper"
-if "persona" not in st.session_state:
-    st.session_state.persona = "Helper"
-if "upload_collection_name" not in st.session_state:
-    import uuid
-    # kept for backward compatibility / tracing
-    st.session_state.upload_collection_name = f"user_uploads_{uuid.uuid4().hex[:8]}"
-# NEW: store summaries of uploaded papers
-if "paper_summaries" not in st.session_state:
-    st.session_state.paper_summaries: Dict[str, str] = {}
-if "summarized_paper_count" not in st.session_state:
-    st.session_state.summarized_paper_count = 0
-if "last_task" not in st.session_state:
-    st.session_state.last_task = "(none)"
+init_session_state(st.session_state)
 
-# -------- summary utils -------- #
 
-SELF_REF_RE = re.compile(
-    r"\[Self-Reflection Checklist\].*?(?:\Z|\n{2,})",
-    re.IGNORECASE | re.DOTALL,
-)
-PROMPTY_RE = re.compile(
-    r"\[Write (?:the )?updated summary below\]\s*",
-    re.IGNORECASE,
-)
+def _merge_pending_summary(wait: bool = False) -> None:
+    # Take over a finished background summary; wait=True blocks until done.
+    pending = st.session_state.pending_summary
+    if pending is None or not (wait or pending.done()):
+        return
+    (
+        st.session_state.summary,
+        st.session_state.last_summarized_index,
+    ) = pending.result()
+    st.session_state.pending_summary = None
 
 
-def _clean_text(text: str) -> str:
-    if not text:
-        return ""
-    text = SELF_REF_RE.sub("", text)
-    text = PROMPTY_RE.sub("", text)
-    text = re.sub(r"\n{3,}", "\n\n", text).strip()
-    return text
+# merge a background summary that finished since the last rerun
+_merge_pending_summary()
+
+# -------- summary utils -------- #
 
 
-def update_summary_ephemeral(history, current_summary: str) -> str:
-    chat_turns = [h for h in history if h.get("kind", "chat") == "chat"]
+def update_summary_ephemeral(
+    history, current_summary: str, start: int = 0
+) -> Tuple[str, int]:
+    # Only the turns after `start` are sent; older ones already live in
+    # current_summary. Returns (summary, index merged up to).
+    new_turns = [h for h in history[start:] if h.get("kind", "chat") == "chat"]
     pairs = []
-    for item in chat_turns:
+    for item in new_turns:
         u = _clean_text(item.get("frage", ""))
         a = _clean_text(item.get("antwort", ""))
         if u or a:
             pairs.append(f"USER: {u}\nASSISTANT: {a}")
-    recent_text = "\n\n".join(pairs) if pairs else "None"
+    if not pairs:
+        return current_summary, len(history)
+    new_text = "\n\n".join(pairs)
     prompt = f"""You are a thesis-proposal assistant's memory summarizer.
 
 Rules:
@@ -93,30 +131,112 @@ Rules:
 [Existing summary]
 {_clean_text(current_summary)}
 
-[Conversation turns to merge]
-{recent_text}
+[New conversation turns since the last summary]
+{new_text}
 
 [Write the updated summary as 3–5 bullets only, no header:]
 """
     try:
         new_summary = llm_complete(prompt, max_tokens=180, temperature=0.0)
-        return _clean_text(new_summary) or current_summary
     except Exception:
-        return current_summary
+        return current_summary, start
+    return _clean_text(new_summary) or current_summary, len(history)
+
+
+def _normalize_metas(metas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # KB chunks carry "quelle", uploaded papers "title"; settle on "title"
+    # once per turn so rendering never has to probe both keys again.
+    for m in metas:
+        m["title"] = (m.get("quelle") or m.get("title") or "Untitled").strip()
+    return metas
+
+
+def _start_background_summary() -> None:
+    # Summarize off the script thread; the result is merged on a later rerun.
+    # While a job is running, new turns stay after last_summarized_index and
+    # go into the next one.
+    if st.session_state.pending_summary is None:
+        st.session_state.pending_summary = get_summary_executor().submit(
+            update_summary_ephemeral,
+            list(st.session_state.history),
+            st.session_state.summary,
+            st.session_state.last_summarized_index,
+        )
+
+
+def _unique_titles(metas: List[Dict[str, Any]]) -> List[str]:
+    # ordered de-duplication of source titles (metas already normalized)
+    return list(dict.fromkeys(m["title"] for m in metas))
+
+
+def _recent_qas_text(history) -> str:
+    recent = [
+        h for h in history[-MAX_RECENT_TURNS:] if h.get("kind", "chat") == "chat"
+    ]
+    return "\n\n".join(
+        f"Q: {h.get('frage', '')}\nA: {h.get('antwort', '')}" for h in recent
+    )
 
 
 # -------- wrapper: call LangGraph -------- #
 
+_STREAM_DONE = object()
+
+
+def _iter_answer_chunks(graph, initial_state, config, final: Dict[str, Any]):
+    """
+    Run the async graph on the shared event loop and yield the answer chunks
+    that nodes emit on the "custom" stream; `final` receives the last state.
+    """
+    chunks: "queue.Queue[Any]" = queue.Queue()
+
+    async def _consume():
+        async for mode, payload in graph.astream(
+            initial_state, config=config, stream_mode=["custom", "values"]
+        ):
+            if mode == "custom":
+                chunks.put(payload)
+            else:
+                final.clear()
+                final.update(payload)
+
+    def _finished(fut):
+        exc = None if fut.cancelled() else fut.exception()
+        if exc is not None:
+            chunks.put(exc)
+        chunks.put(_STREAM_DONE)
+
+    # Runs on rag_tools' long-lived loop, which owns the shared HTTP clients.
+    submit_async(_consume()).add_done_callback(_finished)
+    while (item := chunks.get()) is not _STREAM_DONE:
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def _run_graph(graph, initial_state, config) -> Dict[str, Any]:
+    # Renders the answer in the current container while it is generated.
+    # Answers that are not streamed (e.g. the "no summaries yet" notices)
+    # emit nothing, so the final answer is shown instead.
+    final_state: Dict[str, Any] = {}
+    streamed = st.write_stream(_iter_answer_chunks(graph, initial_state, config, final_state))
+    if not streamed:
+        st.markdown(final_state.get("answer", ""))
+    return final_state
+
+
 def answer_with_rag_and_memory(question: str) -> Dict[str, Any]:
-    recent_qas_text = "\n\n".join(
-        [
-            f"Q: {h.get('frage', '')}\nA: {h.get('antwort', '')}"
-            for h in st.session_state.history
-            if h.get("kind", "chat") == "chat"
-        ]
-    ) or "None"
+    recent_qas_text = st.session_state.recent_qas_text or "None"
 
     mode = st.session_state.mode
+    run_config = {
+        "callbacks": [get_langfuse_handler()],
+        "metadata": {
+            "session_id": st.session_state.get("upload_collection_name", "unknown"),
+            "mode": mode,
+            "persona": st.session_state.persona,
+        },
+    }
 
     # ---------------------------
     # 1) Proposal refinement mode
@@ -132,68 +252,34 @@ def answer_with_rag_and_memory(question: str) -> Dict[str, Any]:
             "answer": "",
         }
 
-        final_state = proposal_graph.invoke(
-            initial_state,
-            config={
-                "callbacks": [LANGFUSE_HANDLER],
-                "metadata": {
-                    "session_id": st.session_state.get(
-                        "upload_collection_name", "unknown"
-                    ),
-                    "mode": mode,
-                    "persona": st.session_state.persona,
-                },
-            },
-        )
+        final_state = _run_graph(proposal_graph, initial_state, run_config)
 
     # ---------------------------
     # 2) Research question mode
     # ---------------------------
     else:
-        initial_state: AppState = {
-            "question": question,
-            "mode": mode,
-            "persona": st.session_state.persona,
-            "summary": st.session_state.summary,
-            "recent_qas": recent_qas_text,
-            "task": "structure_question",  # router will overwrite
-            "upload_collection_name": st.session_state.upload_collection_name,
-            "context_docs": [],
-            "selected_titles": [],
-            "metadatas": [],
-            "answer": "",
-            # gap pipeline fields
-            "gap_paper_docs": [],
-            "gap_paper_metas": [],
-            "gap_paper_summaries": "",
-            "gap_guides": "",
-            "gap_candidates": "",
-            "rq_candidates": "",
-            # methods pipeline fields
-            "methods_task": "critique_design",
-            "methods_guides": "",
-        }
-
-        final_state = rag_graph.invoke(
-            initial_state,
-            config={
-                "callbacks": [LANGFUSE_HANDLER],
-                "metadata": {
-                    "session_id": st.session_state.get(
-                        "upload_collection_name", "unknown"
-                    ),
-                    "mode": mode,
-                    "persona": st.session_state.persona,
-                },
-            },
+        # unset pipeline fields take the AppState defaults
+        initial_state = AppState(
+            question=question,
+            mode=mode,
+            persona=st.session_state.persona,
+            summary=st.session_state.summary,
+            recent_qas=recent_qas_text,
+            task="structure_question",  # router will overwrite
+            upload_collection_name=st.session_state.upload_collection_name,
+            paper_summaries=st.session_state.paper_summaries,
+            gap_paper_summaries=st.session_state.gap_paper_summaries,
         )
 
+        final_state = _run_graph(rag_graph, initial_state, run_config)
+
+    metas = _normalize_metas(final_state.get("metadatas", []))
     st.session_state.last_task = final_state.get("task", "?")
-    st.session_state.recent_sources = final_state.get("metadatas", [])
+    st.session_state.recent_sources = metas
 
     return {
         "antwort": final_state["answer"],
-        "quellen": final_state.get("metadatas", []),
+        "quellen": metas,
     }
 
 
@@ -217,9 +303,12 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True,
 )
 if uploaded_files and st.sidebar.button("Summarize uploaded papers"):
-    summaries = summarize_uploaded_papers(uploaded_files)
+    summaries = summarize_uploaded_papers(uploaded_files, cache=get_paper_summary_cache())
     # Merge with existing ones (so you can add more later)
     st.session_state.paper_summaries.update(summaries)
+    st.session_state.gap_paper_summaries = canonical_paper_summaries(
+        st.session_state.paper_summaries
+    )
     st.session_state.summarized_paper_count = len(st.session_state.paper_summaries)
 
     st.sidebar.success(
@@ -239,14 +328,10 @@ st.sidebar.markdown(
 )
 
 st.sidebar.subheader("Assistant Mode")
-modes = ["Research question helper", "Proposal refinement assistant"]
-current_index = (
-    modes.index(st.session_state.mode) if st.session_state.mode in modes else 0
-)
 st.session_state.mode = st.sidebar.radio(
     "Select a mode",
-    modes,
-    index=current_index,
+    MODES,
+    index=MODE_INDEX.get(st.session_state.mode, 0),
     label_visibility="collapsed",
     key="mode_select",
 )
@@ -254,11 +339,25 @@ st.session_state.mode = st.sidebar.radio(
 st.sidebar.subheader("Answer style")
 st.session_state.persona = st.sidebar.radio(
     "Choose style",
-    ["Supervisor", "Helper", "Creative"],
-    index=["Supervisor", "Helper", "Creative"].index(st.session_state.persona),
+    PERSONAS,
+    index=PERSONA_INDEX.get(st.session_state.persona, 1),
 )
 
 if st.sidebar.button("Summarize conversation"):
+    # Explicit request: finish a running job first. Its snapshot may predate
+    # the latest turns, so those go into a fresh job from where it stopped.
+    if (
+        st.session_state.pending_summary is not None
+        or st.session_state.last_summarized_index < len(st.session_state.history)
+    ):
+        with st.sidebar:
+            with st.spinner("Summarizing..."):
+                _merge_pending_summary(wait=True)
+                if st.session_state.last_summarized_index < len(
+                    st.session_state.history
+                ):
+                    _start_background_summary()
+                    _merge_pending_summary(wait=True)
     summary_text = st.session_state.summary or "No summary yet - start chatting!"
     st.sidebar.markdown("### Session Summary")
     st.sidebar.write(summary_text)
@@ -266,9 +365,13 @@ if st.sidebar.button("Summarize conversation"):
 if st.sidebar.button("Reset session"):
     st.session_state.history = []
     st.session_state.summary = ""
+    st.session_state.recent_qas_text = ""
     st.session_state.recent_sources = []
     st.session_state.paper_summaries = {}
+    st.session_state.gap_paper_summaries = ""
     st.session_state.summarized_paper_count = 0
+    st.session_state.last_summarized_index = 0
+    st.session_state.pending_summary = None
     st.experimental_rerun()
 
 # -------- UI: main chat -------- #
@@ -281,35 +384,42 @@ for item in st.session_state.history:
         st.markdown(item.get("frage", ""))
     with st.chat_message("assistant"):
         st.markdown(item.get("antwort", ""))
-        if item.get("quellen"):
-            seen = set()
-            uniq_titles = []
-            for meta in item["quellen"]:
-                title = (meta.get("quelle") or meta.get("title") or "Untitled").strip()
-                if title not in seen:
-                    seen.add(title)
-                    uniq_titles.append(title)
-            if uniq_titles:
-                st.markdown("Sources (ephemeral):")
-                for title in uniq_titles:
-                    st.markdown(f"- {title}")
+        # computed once when the turn was stored; older items fall back
+        uniq_titles = item.get("uniq_titles")
+        if uniq_titles is None:
+            uniq_titles = _unique_titles(_normalize_metas(item.get("quellen") or []))
+        if uniq_titles:
+            st.markdown("Sources (ephemeral):")
+            for title in uniq_titles:
+                st.markdown(f"- {title}")
         st.markdown("---")
 
 frage = st.chat_input("Ask a question...")
 
 if frage:
-    with st.spinner("Thinking..."):
-        result = answer_with_rag_and_memory(frage)
-        st.session_state.history.append(
-            {
-                "kind": "chat",
-                "frage": frage,
-                "antwort": result["antwort"],
-                "quellen": result["quellen"],
-            }
-        )
-        st.session_state.summary = update_summary_ephemeral(
-            history=st.session_state.history,
-            current_summary=st.session_state.summary,
-        )
-        st.rerun()
+    with st.chat_message("user"):
+        st.markdown(frage)
+    with st.chat_message("assistant"):
+        with st.spinner("Thinking..."):
+            # answer text is streamed into this bubble as it is generated
+            result = answer_with_rag_and_memory(frage)
+
+    st.session_state.history.append(
+        {
+            "kind": "chat",
+            "frage": frage,
+            "antwort": result["antwort"],
+            "quellen": result["quellen"],
+            "uniq_titles": _unique_titles(result["quellen"]),
+        }
+    )
+    st.session_state.recent_qas_text = _recent_qas_text(st.session_state.history)
+    # Only summarize once enough new material has piled up; until then the
+    # unsummarized turns are still covered by the [Recent Q&A] window.
+    new_turns = len(st.session_state.history) - st.session_state.last_summarized_index
+    if (
+        new_turns >= SUMMARY_MIN_NEW_TURNS
+        or len(frage) + len(result["antwort"]) > SUMMARY_MIN_TURN_CHARS
+    ):
+        _start_background_summary()
+    st.rerun()
@@ -1,73 +1,84 @@
 # graph_config.py
 
+import asyncio
+import os
 import re
-from typing import TypedDict, List, Dict, Any
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 
 from langgraph.graph import StateGraph, END
-
-from prompts import RAG_SAFETY_PREAMBLE, MODE_INSTR, PERSONA_MAP
-from rag_tools import llm_complete, retrieve_kb_context
-from llm_service import llm_service 
+from langgraph.types import StreamWriter
+
+from prompts import (
+    RAG_SAFETY_PREAMBLE,
+    PERSONA_MAP,
+    estimate_tokens,
+    persona_header,
+    prompt_template,
+    truncate_to_tokens,
+    usable_context,
+)
+from rag_tools import (
+    aembed_text_ollama,
+    allm_complete,
+    aretrieve_kb_context,
+    embed_text_ollama,
+    llm_complete,
+    llm_complete_streaming,
+)
+from semantic_cache import CACHE_DIR, SemanticCache, normalize_question
+from llm_service import get_llm_service
 
 # -------------------------------------------------------------------
 # App state
 # -------------------------------------------------------------------
 
-class AppState(TypedDict):
+@dataclass(slots=True)
+class AppState:
+    # Nodes read fields as attributes and return dicts with only the keys
+    # they write; LangGraph merges those into the next state object.
+
     # core
-    question: str
-    mode: str
-    persona: str
-    summary: str
-    recent_qas: str
-    task: str                      # "paper_question" | "structure_question" | "gap_analysis"
-    upload_collection_name: str    # kept for tracing / compatibility
+    question: str = ""
+    mode: str = "Research question helper"
+    persona: str = "Helper"
+    summary: str = ""
+    recent_qas: str = "None"
+    task: str = ""                 # "paper_question" | "structure_question" | "gap_analysis"
+    upload_collection_name: str = ""  # kept for tracing / compatibility
 
     # NEW: summaries of uploaded PDFs
     # filename -> markdown summary (created by BFH LLM at upload time)
-    paper_summaries: Dict[str, str]
+    paper_summaries: Dict[str, str] = field(default_factory=dict)
 
     # which filenames the user explicitly mentioned in the question
-    selected_titles: List[str]
+    selected_titles: List[str] = field(default_factory=list)
 
     # generic RAG outputs (still used for UI / sources)
-    context_docs: List[str]
-    metadatas: List[Dict[str, Any]]
-    answer: str
+    context_docs: List[str] = field(default_factory=list)
+    metadatas: List[Dict[str, Any]] = field(default_factory=list)
+    answer: str = ""
 
     # gap pipeline intermediates
-    gap_paper_summaries: str
-    gap_guides: str
-    gap_candidates: str
-    rq_candidates: str
+    gap_paper_summaries: str = ""
+    gap_guides: str = ""
+    gap_candidates: str = ""
+    rq_candidates: str = ""
 
     # methods pipeline intermediates
-    methods_task: str      # "critique_design" | "propose_design" | "refine_question"
-    methods_guides: str    # concatenated Creswell/BFH guidance
+    methods_task: str = ""     # "critique_design" | "propose_design" | "refine_question"
+    methods_guides: str = ""   # concatenated Creswell/BFH guidance
 
 
 # -------------------------------------------------------------------
 # Router
 # -------------------------------------------------------------------
 
-def router_node(state: AppState) -> AppState:
-    """
-    LLM-based routing agent using the BFH GPT-OSS model.
-
-    Decides which specialized pipeline should handle the user's message:
-    - paper_question: questions about uploaded papers/articles
-    - structure_question: research design / methods / RQ / structure
-    - gap_analysis: research gaps & contributions using multiple papers + guidance
-    """
-    user_msg = state["question"]
-    mode = state.get("mode", "")
-    persona = state.get("persona", "")
-    summary = state.get("summary", "")
-    recent_qas = state.get("recent_qas", "")
-
-    # We put all rich context into the *user* message, and keep the system
-    # prompt short and strict about the required output format.
-    user_prompt = f"""{RAG_SAFETY_PREAMBLE}
+# Static routing instructions go in the system message so that the prompt
+# prefix is identical on every turn (provider-side prefix/KV caching); only
+# the short context trailer in the user message changes.
+ROUTER_SYSTEM_PROMPT = f"""{RAG_SAFETY_PREAMBLE}
 
 You are a ROUTING AGENT in a thesis-proposal assistant.
 
@@ -102,9 +113,26 @@ Available agents (choose exactly ONE):
      - "Which research gaps do these studies leave?"
      - "What contribution could my thesis make, based on the literature?"
 
-Context you can use:
+If you choose structure_question, also decide which kind of methods help
+the user wants (for the other agents, write critique_design):
 
-[Current mode]
+- critique_design: the user already has a rough method/plan and wants feedback, strengths/weaknesses, and improvements
+- propose_design: the user mainly has a topic/idea and wants you to propose a concrete study design (data, method, steps)
+- refine_question: the user mainly wants to refine the research question, constructs, and measurement so that a method can be chosen
+
+The user message contains the context you can use, ending with the user's
+latest message.
+
+Output format:
+- Answer with EXACTLY two labels separated by a comma, e.g.
+  structure_question,propose_design
+- The first label is one of: paper_question, structure_question, gap_analysis
+- The second label is one of: critique_design, propose_design, refine_question
+- No explanation, no spaces, nothing else.
+"""
+
+
+ROUTER_USER_TMPL = """[Current mode]
 {mode}
 
 [Persona]
@@ -118,37 +146,135 @@ Context you can use:
 
 [User's latest message]
 {user_msg}
-
-Output format:
-- Answer with EXACTLY ONE WORD:
-  paper_question
-  structure_question
-  gap_analysis
 """
 
-    resp = llm_service.generate_completion(
-        system_prompt=(
-            "You are a routing classifier for a thesis assistant. "
-            "Given the detailed description in the user message, "
-            "respond with exactly ONE of these labels:\n"
-            "- paper_question\n- structure_question\n- gap_analysis\n"
-            "No explanation, no punctuation, just the single word."
-        ),
+_ROUTER_LABEL_RE = re.compile(
+    r"\b(paper_question|structure_question|gap_analysis)\b", re.IGNORECASE
+)
+_METHODS_LABEL_RE = re.compile(
+    r"\b(critique_design|propose_design|refine_question)\b", re.IGNORECASE
+)
+
+
+# Cheap keyword pre-filter: a message that matches exactly one of these goes
+# straight to that pipeline; anything else (none or several) asks the LLM.
+# Only phrases that name the uploaded material or the methods topic count;
+# "summarize my findings", "my paper idea" or a bare "design" are left to
+# the LLM.
+_PAPER_RE = re.compile(
+    r"\bpdfs?\b|\buploaded\b|\b(?:this|these)\s+(?:papers?|articles?)\b",
+    re.IGNORECASE,
+)
+_GAP_RE = re.compile(r"\bgaps?\b|\bcontributions?\b", re.IGNORECASE)
+_METHOD_RE = re.compile(
+    r"\bresearch\s+questions?\b|\bmethod(?:s|ology|ological)?\b"
+    r"|\b(?:research|study)\s+design\b",
+    re.IGNORECASE,
+)
+_FAST_ROUTES = (
+    ("paper_question", _PAPER_RE),
+    ("gap_analysis", _GAP_RE),
+    ("structure_question", _METHOD_RE),
+)
+
+# When set, the LLM still routes every message and disagreements with the
+# pre-filter are printed, to tune the patterns against real traffic.
+ROUTER_FAST_SHADOW = os.getenv("ROUTER_FAST_SHADOW", "").lower() in ("1", "true", "yes")
+
+
+def _fast_route(user_msg: str) -> Optional[str]:
+    hits = [route for route, pattern in _FAST_ROUTES if pattern.search(user_msg)]
+    return hits[0] if len(hits) == 1 else None
+
+def _apply_route(label: str) -> Dict[str, Any]:
+    # cached labels are "route" or "route:methods_task"
+    route, _, methods_task = label.partition(":")
+    update: Dict[str, Any] = {"task": route}
+    if route == "structure_question" and methods_task:
+        update["methods_task"] = methods_task
+    return update
+
+# label caches for the two classifier calls; keyed by normalised question
+ROUTER_CACHE = SemanticCache(path=os.path.join(CACHE_DIR, "router.json"))
+METHODS_TASK_CACHE = SemanticCache(path=os.path.join(CACHE_DIR, "methods_task.json"))
+
+
+async def router_node(state: AppState) -> Dict[str, Any]:
+    """
+    LLM-based routing agent using the BFH GPT-OSS model.
+
+    Decides which specialized pipeline should handle the user's message:
+    - paper_question: questions about uploaded papers/articles
+    - structure_question: research design / methods / RQ / structure
+    - gap_analysis: research gaps & contributions using multiple papers + guidance
+    """
+    user_msg = state.question
+    mode = state.mode
+    persona = state.persona
+    summary = state.summary
+    recent_qas = state.recent_qas
+
+    # Unambiguous keywords route without a model call. The methods task is
+    # left unset, so methods_parse_request classifies it as before.
+    fast_label = _fast_route(user_msg)
+    if fast_label is not None and not ROUTER_FAST_SHADOW:
+        return _apply_route(fast_label)
+
+    # Same (or near-identical) question under the same settings -> same route.
+    scope = f"{mode}|{persona}"
+    cache_key = f"{scope}|{normalize_question(user_msg)}"
+    label = ROUTER_CACHE.get(cache_key)
+    if label is not None:
+        return _apply_route(label)
+    try:
+        q_vec = await aembed_text_ollama(user_msg)
+    except Exception:
+        q_vec = None  # fuzzy lookup is best-effort
+    if q_vec is not None:
+        label = ROUTER_CACHE.get_similar(q_vec, scope=scope)
+        if label is not None:
+            ROUTER_CACHE.put(cache_key, label, q_vec, scope=scope)
+            return _apply_route(label)
+
+    user_prompt = ROUTER_USER_TMPL.format_map(
+        {
+            "mode": mode,
+            "persona": persona,
+            "summary": summary,
+            "recent_qas": recent_qas,
+            "user_msg": user_msg,
+        }
+    )
+
+    resp = await get_llm_service().agenerate_completion(
+        system_prompt=ROUTER_SYSTEM_PROMPT,
         user_prompt=user_prompt,
         temperature=0.0,
     )
 
-    label = resp["text"].strip().lower()
-    if label not in {"paper_question", "structure_question", "gap_analysis"}:
-        # Safe fallback if the model says something unexpected
-        label = "structure_question"
+    # take the first labels the model mentions, tolerating stray punctuation
+    match = _ROUTER_LABEL_RE.search(resp["text"])
+    if match is None:
+        # Safe fallback if the model says something unexpected;
+        # methods_parse_request then classifies the methods task itself
+        return _apply_route("structure_question")
 
-    state["task"] = label
-    return state
+    label = match.group(1).lower()
+    m_match = _METHODS_LABEL_RE.search(resp["text"])
+    if label == "structure_question" and m_match is not None:
+        label = f"{label}:{m_match.group(1).lower()}"
+    ROUTER_CACHE.put(cache_key, label, q_vec, scope=scope)
+    if fast_label is not None and fast_label != label.partition(":")[0]:
+        print(f"Fast route mismatch: fast={fast_label} llm={label} msg={user_msg[:80]!r}")
+    return _apply_route(label)
 
 
 def router_edge(state: AppState) -> str:
-    return state.get("task", "structure_question")
+    task = state.task or "structure_question"
+    if task == "structure_question" and state.methods_task:
+        # the router already picked the methods task; skip the classifier
+        return "structure_question_classified"
+    return task
 
 
 # -------------------------------------------------------------------
@@ -156,6 +282,10 @@ def router_edge(state: AppState) -> str:
 # (now based on precomputed full-paper summaries, not Chroma chunks)
 # -------------------------------------------------------------------
 
+# anything that looks like 'name.pdf'
+_PDF_RE = re.compile(r'([\w\-.]+\.pdf)', re.IGNORECASE)
+
+
 def _extract_pdf_titles(question: str) -> List[str]:
     """
     Extract candidate PDF file names from the user's question.
@@ -163,40 +293,36 @@ def _extract_pdf_titles(question: str) -> List[str]:
     Very simple heuristic: anything that looks like 'name.pdf'.
     Stored as lowercase for matching.
     """
-    pattern = re.compile(r'([\w\-.]+\.pdf)', re.IGNORECASE)
-    return [m.group(1).lower() for m in pattern.finditer(question)]
+    return [m.group(1).lower() for m in _PDF_RE.finditer(question)]
 
 
-def paper_select_scope(state: AppState) -> AppState:
+def paper_select_scope(state: AppState) -> Dict[str, Any]:
     """
     Scope which uploaded files to use:
     - If the user explicitly mentions one or more PDF file names in the question
       (e.g. 'in review.pdf, what...'), we store those (lowercased) in selected_titles.
     - Otherwise, selected_titles = [], meaning: use all summarized papers.
     """
-    titles = _extract_pdf_titles(state["question"])
-    state["selected_titles"] = titles
-    return state
+    titles = _extract_pdf_titles(state.question)
+    return {"selected_titles": titles}
 
 
-def paper_retrieve_passages(state: AppState) -> AppState:
+def paper_retrieve_passages(state: AppState) -> Dict[str, Any]:
     """
     Instead of retrieving vector chunks, we look up the precomputed summaries
-    in state["paper_summaries"].
+    in state.paper_summaries.
 
     - If selected_titles is non-empty, we try to use only those files.
     - If none of the selected_titles exist, we fall back to all summaries.
     """
-    summaries = state.get("paper_summaries") or {}
+    summaries = state.paper_summaries
     docs: List[str] = []
     metas: List[Dict[str, Any]] = []
 
     if not summaries:
-        state["context_docs"] = []
-        state["metadatas"] = []
-        return state
+        return {"context_docs": [], "metadatas": []}
 
-    wanted = [t.lower() for t in (state.get("selected_titles") or [])]
+    wanted = [t.lower() for t in state.selected_titles]
 
     def add_doc(filename: str, text: str):
         docs.append(text)
@@ -213,87 +339,62 @@ def paper_retrieve_passages(state: AppState) -> AppState:
         for filename, summary in summaries.items():
             add_doc(filename, summary)
 
-    state["context_docs"] = docs
-    state["metadatas"] = metas
-    return state
+    return {"context_docs": docs, "metadatas": metas}
 
 
-def paper_synthesize_answer(state: AppState) -> AppState:
-    """
-    Answer questions about uploaded papers using their summaries.
-
-    - context_docs now contain 1+ full-paper summaries (markdown).
-    - metadatas contain at least "title" for each summary.
-
-    We:
-    - build a combined context
-    - send it to Mixtral with strong anti-hallucination rules
-    - also store the combined summaries in gap_paper_summaries
-      so the gap pipeline can reuse them.
-    """
-    docs = state.get("context_docs") or []
-    metas = state.get("metadatas") or []
-
-    if not docs:
-        state["answer"] = (
-            "I couldn't find any summaries of your uploaded papers.\n\n"
-            "Please upload PDFs in the sidebar, click **“Summarize uploaded papers”**, "
-            "and then ask your question again."
-        )
-        state["gap_paper_summaries"] = ""
-        return state
+# Context window of the Together model; retrieved/uploaded text is fitted
+# into what is left after the prompt scaffold, the answer and a margin.
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "32768"))
+SAFETY_MARGIN_TOKENS = 256
+ANSWER_MAX_TOKENS = 900
+PER_PAPER_MAX_TOKENS = 400
 
-    persona = state.get("persona", "Helper")
-    mode = state.get("mode", "Research question helper")
-    summary = state.get("summary", "")
-    recent_qas_text = state.get("recent_qas", "None")
 
-    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
+def _context_budget(prompt_without_context: str, max_tokens: int) -> int:
+    """Tokens left for context next to the rest of the prompt and the answer."""
+    return (
+        usable_context(LLM_CONTEXT_TOKENS)
+        - estimate_tokens(prompt_without_context)
+        - max_tokens
+        - SAFETY_MARGIN_TOKENS
+    )
 
-    # combined summaries (also reused for gap analysis)
-    combined_summaries = ""
-    paper_titles = []
-    seen = set()
 
-    for doc_text, meta in zip(docs, metas):
-        title = (meta.get("title") or "uploaded paper").strip()
-        if title not in seen:
-            seen.add(title)
-            paper_titles.append(title)
+PAPER_NOTES_PREFIX = f"""{RAG_SAFETY_PREAMBLE}
 
-        combined_summaries += doc_text.strip() + "\n\n"
+You are reading the structured summary of ONE uploaded research paper on behalf of a thesis assistant.
 
-    titles_str = ", ".join(paper_titles) if paper_titles else "the uploaded papers"
+TASK:
+- Write short notes on what THIS summary says that is relevant to the user's question.
+- Use ONLY the summary given below; do NOT invent authors, years, sample sizes or findings.
+- If the summary contains nothing relevant, reply exactly: "Not covered in this paper's summary."
+- Start your notes with a "####" heading holding the paper's title.
+"""
 
-    # hard cap for safety
-    MAX_CONTEXT_CHARS = 15000
-    if len(combined_summaries) > MAX_CONTEXT_CHARS:
-        combined_summaries = combined_summaries[:MAX_CONTEXT_CHARS]
 
-    state["gap_paper_summaries"] = combined_summaries.strip()
+PAPER_NOTES_TMPL = prompt_template(PAPER_NOTES_PREFIX, """
+[Summary of "{title}"]
+{doc_text}
 
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
+[User Question]
+{question}
+""")
 
-You are a thesis assistant helping the student reason about their uploaded research papers.
-You have access to structured summaries of each paper.
 
-Mode: {mode}
-Persona: {persona} — {style["instr"]}
+def _paper_notes_prompt(title: str, doc_text: str, question: str) -> str:
+    return PAPER_NOTES_TMPL.format_map(
+        {"title": title, "doc_text": doc_text, "question": question}
+    )
 
-[Session summary]
-{summary}
 
-[Recent Q&A]
-{recent_qas_text}
+# stable part of the paper answer prompt; the dynamic blocks follow it
+PAPER_ANSWER_PREFIX = f"""{RAG_SAFETY_PREAMBLE}
 
-[Summaries of uploaded papers: {titles_str}]
-{combined_summaries}
-
-[User Question]
-{state["question"]}
+You are a thesis assistant helping the student reason about their uploaded research papers.
+You have access to structured summaries of each paper, given further below.
 
 TASK RULES (VERY IMPORTANT):
-- Answer the question using ONLY the information that appears in the paper summaries above.
+- Answer the question using ONLY the information that appears in the paper summaries below.
 - Do NOT invent: author names, publication years, number of studies, sample sizes, exact section structures, or detailed findings that are not clearly present.
 - If the user asks "what is paper X about?", give a concise structured answer summarising:
   - topic / problem
@@ -303,216 +404,402 @@ TASK RULES (VERY IMPORTANT):
   - limitations or gaps (only if mentioned)
 - If the summaries do not contain enough information to fully answer the question, say so explicitly and suggest what the student could check in the original PDF.
 - Do NOT guess or fill in missing parts with generic advice. It is better to say “not specified in the summaries” than to make something up.
-
-Now provide a clear, honest answer that follows these rules.
 """
-    answer = llm_complete(prompt, max_tokens=900, temperature=style["temp"])
-    state["answer"] = answer
-    return state
+
+PAPER_ANSWER_TMPL = prompt_template(PAPER_ANSWER_PREFIX, """
+Mode: {mode}
+Persona: {persona} — {persona_instr}
+
+[Session summary]
+{summary}
+
+[Recent Q&A]
+{recent_qas}
+
+[{context_label}]
+{context}
+
+[User Question]
+{question}
+
+Now provide a clear, honest answer that follows the task rules.
+""")
+
+
+def _summary_block(filename: str, summary: str) -> str:
+    # summarize_uploaded_papers already stores summaries with their
+    # "## <filename>" heading; only add it for summaries from elsewhere
+    if summary.startswith("## "):
+        return summary
+    text = summary.strip()
+    return text if text.startswith("## ") else f"## {filename}\n\n{text}"
+
+
+def canonical_paper_summaries(paper_summaries: Dict[str, str]) -> str:
+    """
+    The one concatenation of all paper summaries ("## <filename>" blocks)
+    used as gap_paper_summaries. Built by the UI whenever paper_summaries
+    changes and passed in with the initial state.
+    """
+    return "\n\n".join(
+        _summary_block(filename, summary)
+        for filename, summary in paper_summaries.items()
+    )
+
+
+@lru_cache(maxsize=32)
+def _combine_paper_context(docs: Tuple[str, ...], titles: Tuple[str, ...]) -> Tuple[str, str]:
+    # The summaries are the same str objects on every turn of a session
+    # (hashes are cached), so this runs once per upload/selection.
+    # same blocks as canonical_paper_summaries(), so with all papers
+    # selected the context is byte-identical to the gap pipeline's
+    combined = "\n\n".join(
+        _summary_block(title, doc_text) for title, doc_text in zip(titles, docs)
+    )
+    paper_titles = list(dict.fromkeys(titles))
+    titles_str = ", ".join(paper_titles) if paper_titles else "the uploaded papers"
+    return combined, titles_str
+
+
+async def paper_synthesize_answer(state: AppState, writer: StreamWriter) -> Dict[str, Any]:
+    """
+    Answer questions about uploaded papers using their summaries.
+
+    - context_docs now contain 1+ full-paper summaries (markdown).
+    - metadatas contain at least "title" for each summary.
+
+    We:
+    - build a combined context; if it does not fit the token budget,
+      first extract per-paper notes with one concurrent LLM call per paper
+      (instead of truncating) and answer from those notes
+    - send it to Mixtral with strong anti-hallucination rules, streaming
+      the answer through the graph's custom stream
+    """
+    docs = state.context_docs
+    metas = state.metadatas
+
+    if not docs:
+        return {
+            "answer": (
+                "I couldn't find any summaries of your uploaded papers.\n\n"
+                "Please upload PDFs in the sidebar, click **“Summarize uploaded papers”**, "
+                "and then ask your question again."
+            )
+        }
+
+    persona = state.persona
+    mode = state.mode
+    summary = state.summary
+    recent_qas_text = state.recent_qas
+    question = state.question
+
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
+
+    titles = tuple((meta.get("title") or "uploaded paper").strip() for meta in metas)
+    combined_summaries, titles_str = _combine_paper_context(tuple(docs), titles)
+
+    fields = {
+        "mode": mode,
+        "persona": persona,
+        "persona_instr": style["instr"],
+        "summary": summary,
+        "recent_qas": recent_qas_text,
+        "context_label": f"Summaries of uploaded papers: {titles_str}",
+        "context": "",
+        "question": question,
+    }
+    budget = _context_budget(PAPER_ANSWER_TMPL.format_map(fields), ANSWER_MAX_TOKENS)
+
+    if estimate_tokens(combined_summaries) <= budget:
+        fields["context"] = combined_summaries
+    else:
+        # map: one call per paper, awaited together
+        paper_budget = _context_budget(
+            _paper_notes_prompt("", "", question), PER_PAPER_MAX_TOKENS
+        )
+        notes = await asyncio.gather(
+            *(
+                allm_complete(
+                    _paper_notes_prompt(
+                        title, truncate_to_tokens(doc_text.strip(), paper_budget), question
+                    ),
+                    max_tokens=PER_PAPER_MAX_TOKENS,
+                    temperature=style["temp"],
+                )
+                for title, doc_text in zip(titles, docs)
+            )
+        )
+        fields["context_label"] = (
+            f"Per-paper notes extracted from the summaries of: {titles_str}"
+        )
+        fields["context"] = truncate_to_tokens("\n\n".join(notes), budget)
+
+    prompt = PAPER_ANSWER_TMPL.format_map(fields)
+    # reduce: the blocking streamed call runs in a worker thread so the
+    # shared event loop is not held up meanwhile
+    answer = await asyncio.to_thread(
+        llm_complete_streaming,
+        prompt,
+        writer,
+        max_tokens=ANSWER_MAX_TOKENS,
+        temperature=style["temp"],
+    )
+    return {"answer": answer}
 
 
 # -------------------------------------------------------------------
 # METHODS PIPELINE:
 # parse_request → retrieve_guidance → apply_guidance
+# (parse_request only runs when the router did not already pick methods_task)
 # -------------------------------------------------------------------
 
-def methods_parse_request(state: AppState) -> AppState:
-    """
-    Decide what type of methods help the user wants:
-    - critique_design: critique + improve an existing idea
-    - propose_design: design a method from scratch for a topic
-    - refine_question: refine/operationalize an RQ + link to methods
-    """
-    user_msg = state["question"]
+# Numbered options: a one-digit answer instead of a multi-token label word.
+METHODS_TASK_BY_NUMBER = {
+    "1": "critique_design",
+    "2": "propose_design",
+    "3": "refine_question",
+}
 
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
+METHODS_CLASSIFIER_PREFIX = f"""{RAG_SAFETY_PREAMBLE}
 
-You classify the user's request about methodology into exactly one label:
+You classify the user's request about methodology into exactly one category:
 
-- critique_design: the user already has a rough method/plan and wants feedback, strengths/weaknesses, and improvements
-- propose_design: the user mainly has a topic/idea and wants you to propose a concrete study design (data, method, steps)
-- refine_question: the user mainly wants to refine the research question, constructs, and measurement so that a method can be chosen
+1. critique_design: the user already has a rough method/plan and wants feedback, strengths/weaknesses, and improvements
+2. propose_design: the user mainly has a topic/idea and wants you to propose a concrete study design (data, method, steps)
+3. refine_question: the user mainly wants to refine the research question, constructs, and measurement so that a method can be chosen
+"""
 
+METHODS_CLASSIFIER_TMPL = prompt_template(METHODS_CLASSIFIER_PREFIX, """
 User message:
 {user_msg}
 
-Answer with only one word: critique_design, propose_design, or refine_question.
-"""
-    label = llm_complete(prompt, max_tokens=3, temperature=0.0).strip().lower()
-    if label not in {"critique_design", "propose_design", "refine_question"}:
+Answer with only the number (1, 2 or 3).
+Answer:""")
+
+
+def methods_parse_request(state: AppState) -> Dict[str, Any]:
+    """
+    Decide what type of methods help the user wants:
+    - critique_design: critique + improve an existing idea
+    - propose_design: design a method from scratch for a topic
+    - refine_question: refine/operationalize an RQ + link to methods
+    """
+    user_msg = state.question
+
+    cache_key = normalize_question(user_msg)
+    label = METHODS_TASK_CACHE.get(cache_key)
+    if label is not None:
+        return {"methods_task": label}
+    try:
+        q_vec = embed_text_ollama(user_msg)
+    except Exception:
+        q_vec = None
+    if q_vec is not None:
+        label = METHODS_TASK_CACHE.get_similar(q_vec)
+        if label is not None:
+            METHODS_TASK_CACHE.put(cache_key, label, q_vec)
+            return {"methods_task": label}
+
+    prompt = METHODS_CLASSIFIER_TMPL.format_map({"user_msg": user_msg})
+    # A single digit is all we need; the second token allows for a leading
+    # space, which the Mixtral tokenizer emits as a token of its own.
+    reply = llm_complete(prompt, max_tokens=2, temperature=0.0)
+    digit = next((ch for ch in reply if ch.isdigit()), "")
+    label = METHODS_TASK_BY_NUMBER.get(digit)
+    if label is None:
         label = "critique_design"
-    state["methods_task"] = label
-    return state
+    else:
+        METHODS_TASK_CACHE.put(cache_key, label, q_vec)
+    return {"methods_task": label}
+
 
+# fixed query suffixes, so repeated questions give identical (cacheable) KB queries
+_FLAVOR_CRITIQUE = " (research design evaluation, validity, reliability, sampling, data collection, BFH thesis requirements)"
+_FLAVOR_PROPOSE = " (how to design a study, data sources, methods choice, Creswell designs, BFH guidelines)"
+_FLAVOR_REFINE = " (good research questions, operationalization, variables, constructs, Creswell research questions)"
+_FLAVOR_GAPS = " (research gaps, contribution, how to identify gaps, how to formulate research questions)"
 
-def methods_retrieve_guidance(state: AppState) -> AppState:
+
+async def methods_retrieve_guidance(state: AppState) -> Dict[str, Any]:
     """
     RAG over Creswell + BFH docs to get methods guidance.
     This does NOT use uploaded papers, only the methods KB.
     """
-    base_q = state["question"]
-    methods_task = state.get("methods_task", "critique_design")
+    base_q = state.question
+    methods_task = state.methods_task or "critique_design"
 
     # Lightly "flavor" the KB query depending on the task
     if methods_task == "critique_design":
-        flavored = base_q + " (research design evaluation, validity, reliability, sampling, data collection, BFH thesis requirements)"
+        flavored = base_q + _FLAVOR_CRITIQUE
     elif methods_task == "propose_design":
-        flavored = base_q + " (how to design a study, data sources, methods choice, Creswell designs, BFH guidelines)"
+        flavored = base_q + _FLAVOR_PROPOSE
     else:  # refine_question
-        flavored = base_q + " (good research questions, operationalization, variables, constructs, Creswell research questions)"
+        flavored = base_q + _FLAVOR_REFINE
 
-    docs, metas = retrieve_kb_context(flavored, n_results=8)
-    state["context_docs"] = docs
-    state["metadatas"] = metas
-    state["methods_guides"] = "\n\n".join(docs)
-    return state
+    docs, metas = await aretrieve_kb_context(flavored, n_results=8)
+    return {
+        "context_docs": docs,
+        "metadatas": metas,
+        "methods_guides": "\n\n".join(docs),
+    }
 
 
-def methods_apply_guidance(state: AppState) -> AppState:
-    """
-    Use Creswell/BFH methods guidance to critique or propose a method.
-    Does NOT look at uploaded papers; it only has the user's message + methods_guides.
-    """
-    persona = state.get("persona", "Helper")
-    mode = state.get("mode", "Research question helper")
-    summary = state.get("summary", "")
-    recent_qas_text = state.get("recent_qas", "None")
-    methods_task = state.get("methods_task", "critique_design")
-    guides = state.get("methods_guides", "")
-    user_msg = state["question"]
+METHODS_COACH_PREFIX = f"""{RAG_SAFETY_PREAMBLE}
 
-    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
-    mode_instr = MODE_INSTR.get(mode, MODE_INSTR["Research question helper"])
+You are a BFH thesis methods coach.
+Use ONLY the Creswell/BFH guidance given below and the user's message.
+Do NOT assume detailed access to their uploaded papers here.
 
-    if methods_task == "critique_design":
-        focus_text = (
-            "Critique the existing design described by the user. "
-            "Identify strengths, weaknesses, risks (validity/reliability), and missing pieces. "
-            "Then propose concrete improvements (e.g., better sampling, clearer measures, feasible data sources)."
-        )
-    elif methods_task == "propose_design":
-        focus_text = (
-            "Propose a concrete study design for the user's topic. "
-            "Specify: research approach (e.g., qualitative/quantitative/mixed), data sources, sampling, "
-            "data collection method, and main analysis steps. "
-            "Keep it realistic for a BFH bachelor/master thesis."
-        )
-    else:  # refine_question
-        focus_text = (
-            "Refine the research question(s) and key constructs. "
-            "Make questions more specific and measurable. "
-            "Explain briefly how the refined question links to possible methods/data."
-        )
+TASK:
+- Follow the FOCUS given below.
+- Be explicit about trade-offs (e.g., internal vs external validity, feasibility vs ambition).
+- If the user’s idea is unrealistic for a thesis, say so gently and suggest a more feasible variant.
 
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
+Return a clear, structured answer (with short headings) that the student can directly use to improve their methods section.
+"""
 
-You are a BFH thesis methods coach.
-Use ONLY the Creswell/BFH guidance below and the user's message.
-Do NOT assume detailed access to their uploaded papers here.
+METHODS_FOCUS = {
+    "critique_design": (
+        "Critique the existing design described by the user. "
+        "Identify strengths, weaknesses, risks (validity/reliability), and missing pieces. "
+        "Then propose concrete improvements (e.g., better sampling, clearer measures, feasible data sources)."
+    ),
+    "propose_design": (
+        "Propose a concrete study design for the user's topic. "
+        "Specify: research approach (e.g., qualitative/quantitative/mixed), data sources, sampling, "
+        "data collection method, and main analysis steps. "
+        "Keep it realistic for a BFH bachelor/master thesis."
+    ),
+    "refine_question": (
+        "Refine the research question(s) and key constructs. "
+        "Make questions more specific and measurable. "
+        "Explain briefly how the refined question links to possible methods/data."
+    ),
+}
+
+METHODS_COACH_TMPL = prompt_template(METHODS_COACH_PREFIX, """
+FOCUS:
+- {focus_text}
 
-Mode: {mode}. Instruction: {mode_instr}
-Persona: {persona} — {style["instr"]}
+{persona_header}
 
 [Session summary]
 {summary}
 
 [Recent Q&A]
-{recent_qas_text}
+{recent_qas}
 
 [Methods guidance from Creswell / BFH]
 {guides}
 
 [User's message about methods]
 {user_msg}
+""")
 
-TASK:
-- {focus_text}
-- Be explicit about trade-offs (e.g., internal vs external validity, feasibility vs ambition).
-- If the user’s idea is unrealistic for a thesis, say so gently and suggest a more feasible variant.
 
-Return a clear, structured answer (with short headings) that the student can directly use to improve their methods section.
-"""
-    answer = llm_complete(prompt, max_tokens=900, temperature=style["temp"])
-    state["answer"] = answer
-    return state
+def methods_apply_guidance(state: AppState, writer: StreamWriter) -> Dict[str, Any]:
+    """
+    Use Creswell/BFH methods guidance to critique or propose a method.
+    Does NOT look at uploaded papers; it only has the user's message + methods_guides.
+    """
+    persona = state.persona
+    mode = state.mode
+    summary = state.summary
+    recent_qas_text = state.recent_qas
+    methods_task = state.methods_task or "critique_design"
+    guides = state.methods_guides
+    user_msg = state.question
+
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
+
+    focus_text = METHODS_FOCUS.get(methods_task, METHODS_FOCUS["critique_design"])
+
+    fields = {
+        "focus_text": focus_text,
+        "persona_header": persona_header(mode, persona),
+        "summary": summary,
+        "recent_qas": recent_qas_text,
+        "guides": "",
+        "user_msg": user_msg,
+    }
+    budget = _context_budget(METHODS_COACH_TMPL.format_map(fields), ANSWER_MAX_TOKENS)
+    fields["guides"] = truncate_to_tokens(guides, budget)
+    prompt = METHODS_COACH_TMPL.format_map(fields)
+    answer = llm_complete_streaming(
+        prompt, writer, max_tokens=ANSWER_MAX_TOKENS, temperature=style["temp"]
+    )
+    return {"answer": answer}
 
 
 # -------------------------------------------------------------------
 # GAP PIPELINE:
-# collect_inputs → summarize_papers (noop) → retrieve_guides
-#                → propose_gaps → propose_rqs → format_answer
+# fork ─┬→ collect_inputs  ─┬→ propose_gaps → propose_rqs → format_answer
+#       └→ retrieve_guides ─┘
+# The two input nodes are independent and run in the same step; as parallel
+# branches they return only the keys they write.
 # -------------------------------------------------------------------
 
-def gap_collect_inputs(state: AppState) -> AppState:
+def gap_fork(state: AppState) -> Dict[str, Any]:
+    """No-op entry node that fans out to both gap input nodes."""
+    return {}
+
+
+def gap_collect_inputs(state: AppState) -> Dict[str, Any]:
     """
     Prepare summaries of uploaded papers for gap analysis.
 
-    We already have full-paper summaries in state["paper_summaries"], so we
-    simply concatenate them. Each summary usually starts with "## <title>".
+    Normally a no-op: the UI passes the canonical concatenation in
+    state.gap_paper_summaries. It is only rebuilt here when a caller
+    supplied paper_summaries alone.
     """
-    summaries = state.get("paper_summaries") or {}
+    if state.gap_paper_summaries:
+        return {}
 
-    if not summaries:
-        state["gap_paper_summaries"] = (
-            "No paper summaries are available. "
-            "Please upload PDFs, click 'Summarize uploaded papers', "
-            "and then try gap analysis again."
-        )
-        return state
-
-    parts: List[str] = []
-    for filename, summary in summaries.items():
-        text = summary.strip()
-        # ensure each block has a clear heading for the LLM
-        if not text.lower().startswith("## "):
-            text = f"## {filename}\n\n{text}"
-        parts.append(text)
+    summaries = state.paper_summaries
 
-    state["gap_paper_summaries"] = "\n\n".join(parts)
-    return state
+    if not summaries:
+        return {
+            "gap_paper_summaries": (
+                "No paper summaries are available. "
+                "Please upload PDFs, click 'Summarize uploaded papers', "
+                "and then try gap analysis again."
+            )
+        }
 
+    return {"gap_paper_summaries": canonical_paper_summaries(summaries)}
 
 
-def gap_retrieve_guides(state: AppState) -> AppState:
+async def gap_retrieve_guides(state: AppState) -> Dict[str, Any]:
     """
     Retrieve Creswell/BFH guidance related to gaps & research questions.
     """
-    base_q = state["question"]
-    gap_query = base_q + " (research gaps, contribution, how to identify gaps, how to formulate research questions)"
-    docs, metas = retrieve_kb_context(gap_query, n_results=8)
-    state["context_docs"] = docs
-    state["metadatas"] = metas
-    state["gap_guides"] = "\n\n".join(docs)
-    return state
-
-
-def gap_propose_gaps(state: AppState) -> AppState:
-    """
-    Compare what exists in the uploaded papers vs what the guidance says,
-    and propose candidate gaps.
-    """
-    persona = state.get("persona", "Helper")
-    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
-
-    summaries = state.get("gap_paper_summaries", "")
-    guides = state.get("gap_guides", "")
-    user_msg = state["question"]
-
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
-
-You are a thesis research-gap coach. First, look at the summaries of the user's uploaded papers.
-Then, use the methodological guidance to identify plausible gaps.
-
-[Summaries of uploaded papers]
-{summaries}
-
-[Guidance about research gaps & contributions]
+    base_q = state.question
+    gap_query = base_q + _FLAVOR_GAPS
+    docs, metas = await aretrieve_kb_context(gap_query, n_results=8)
+    return {
+        "context_docs": docs,
+        "metadatas": metas,
+        "gap_guides": "\n\n".join(docs),
+    }
+
+
+# Both gap LLM calls start with the same bytes for a given turn (preamble,
+# guidance, user message), so a provider with prefix caching only prefills
+# the task-specific tail of the second call.
+GAP_SHARED_TMPL = prompt_template(f"""{RAG_SAFETY_PREAMBLE}
+
+You are a thesis research-gap and research-question coach.
+""", """
+[Guidance about research gaps, contributions & good research questions]
 {guides}
 
 [User's message about gaps]
 {user_msg}
+""")
 
+GAP_TASK_SUFFIX = prompt_template("""
 TASK:
+- Look at the summaries of the user's uploaded papers given below, then use the guidance above to identify plausible gaps.
 - Propose 3–7 plausible research gaps that are consistent with the paper summaries.
 - For each gap, include:
   - A short title
@@ -521,38 +808,14 @@ TASK:
 - Do NOT assume content that is not supported by the summaries; when you speculate, mark it clearly as a hypothesis.
 
 Return your answer in markdown under the heading "Identified gaps".
-"""
-    gaps = llm_complete(prompt, max_tokens=900, temperature=style["temp"])
-    state["gap_candidates"] = gaps
-    return state
-
-
-def gap_propose_rqs(state: AppState) -> AppState:
-    """
-    Turn the best gaps into concrete research questions.
-    """
-    persona = state.get("persona", "Helper")
-    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
-
-    gaps = state.get("gap_candidates", "")
-    guides = state.get("gap_guides", "")
-    user_msg = state["question"]
-
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
-
-You are a thesis research-question coach.
-
-[Identified gaps]
-{gaps}
-
-[Guidance about good research questions]
-{guides}
-
-[User's message]
-{user_msg}
+""", """
+[Summaries of uploaded papers]
+{summaries}
+""")
 
+RQ_TASK_SUFFIX = prompt_template("""
 TASK:
-- For 3–5 of the strongest gaps, propose 1–2 concrete research questions each.
+- For 3–5 of the strongest gaps given below, propose 1–2 concrete research questions each.
 - Each question should be:
   - specific and focused
   - feasible for a bachelor/master-level thesis
@@ -560,24 +823,65 @@ TASK:
 - For each question, add 1 short sentence explaining why this question would be a useful contribution.
 
 Return your answer in markdown under the heading "Candidate research questions".
-"""
-    rqs = llm_complete(prompt, max_tokens=900, temperature=style["temp"])
-    state["rq_candidates"] = rqs
-    return state
+""", """
+[Identified gaps]
+{gaps}
+""")
 
 
-def gap_format_answer(state: AppState) -> AppState:
+def _gap_shared_prefix(state: AppState) -> str:
+    return GAP_SHARED_TMPL.format_map(
+        {"guides": state.gap_guides, "user_msg": state.question}
+    )
+
+
+def gap_propose_gaps(state: AppState, writer: StreamWriter) -> Dict[str, Any]:
     """
-    Combine gaps + RQs into a final answer with clear sections.
+    Compare what exists in the uploaded papers vs what the guidance says,
+    and propose candidate gaps (streamed as the first answer section).
     """
-    gaps = state.get("gap_candidates", "")
-    rqs = state.get("rq_candidates", "")
+    persona = state.persona
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
 
-    final = f"""### Identified gaps
-{gaps}
+    summaries = state.gap_paper_summaries
+
+    shared = _gap_shared_prefix(state)
+    budget = _context_budget(
+        shared + GAP_TASK_SUFFIX.format_map({"summaries": ""}), ANSWER_MAX_TOKENS
+    )
+    prompt = shared + GAP_TASK_SUFFIX.format_map(
+        {"summaries": truncate_to_tokens(summaries, budget)}
+    )
+    writer(GAP_GAPS_HEADING)
+    gaps = llm_complete_streaming(
+        prompt, writer, max_tokens=ANSWER_MAX_TOKENS, temperature=style["temp"]
+    )
+    return {"gap_candidates": gaps}
 
-### Candidate research questions
-{rqs}
+
+def gap_propose_rqs(state: AppState, writer: StreamWriter) -> Dict[str, Any]:
+    """
+    Turn the best gaps into concrete research questions (streamed as the
+    second answer section).
+    """
+    persona = state.persona
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
+
+    gaps = state.gap_candidates
+
+    prompt = _gap_shared_prefix(state) + RQ_TASK_SUFFIX.format_map({"gaps": gaps})
+    writer(GAP_RQS_HEADING)
+    rqs = llm_complete_streaming(
+        prompt, writer, max_tokens=ANSWER_MAX_TOKENS, temperature=style["temp"]
+    )
+    return {"rq_candidates": rqs}
+
+
+# The final answer is streamed section by section: the two LLM nodes emit
+# their heading and text, gap_format_answer the closing advice.
+GAP_GAPS_HEADING = "### Identified gaps\n"
+GAP_RQS_HEADING = "\n\n### Candidate research questions\n"
+GAP_ANSWER_FOOTER = """
 
 ### How to use this
 - Choose 1–2 gaps that match your interests and constraints (time, data access, skills).
@@ -585,8 +889,18 @@ def gap_format_answer(state: AppState) -> AppState:
 - Use the gaps to justify the relevance of your thesis in the introduction and literature review.
 """
 
-    state["answer"] = final
-    return state
+
+def gap_format_answer(state: AppState, writer: StreamWriter) -> Dict[str, Any]:
+    """
+    Combine gaps + RQs into a final answer with clear sections.
+    """
+    gaps = state.gap_candidates
+    rqs = state.rq_candidates
+
+    writer(GAP_ANSWER_FOOTER)
+    final = GAP_GAPS_HEADING + gaps + GAP_RQS_HEADING + rqs + GAP_ANSWER_FOOTER
+
+    return {"answer": final}
 
 
 # -------------------------------------------------------------------
@@ -608,6 +922,7 @@ graph_builder.add_node("methods_retrieve_guidance", methods_retrieve_guidance)
 graph_builder.add_node("methods_apply_guidance", methods_apply_guidance)
 
 # gap pipeline nodes
+graph_builder.add_node("gap_fork", gap_fork)
 graph_builder.add_node("gap_collect_inputs", gap_collect_inputs)
 graph_builder.add_node("gap_retrieve_guides", gap_retrieve_guides)
 graph_builder.add_node("gap_propose_gaps", gap_propose_gaps)
@@ -622,7 +937,8 @@ graph_builder.add_conditional_edges(
     {
         "paper_question": "paper_select_scope",
         "structure_question": "methods_parse_request",
-        "gap_analysis": "gap_collect_inputs",
+        "structure_question_classified": "methods_retrieve_guidance",
+        "gap_analysis": "gap_fork",
     },
 )
 
@@ -637,8 +953,10 @@ graph_builder.add_edge("methods_retrieve_guidance", "methods_apply_guidance")
 graph_builder.add_edge("methods_apply_guidance", END)
 
 # gap pipeline flow
-graph_builder.add_edge("gap_collect_inputs", "gap_retrieve_guides")
-graph_builder.add_edge("gap_retrieve_guides", "gap_propose_gaps")
+graph_builder.add_edge("gap_fork", "gap_collect_inputs")
+graph_builder.add_edge("gap_fork", "gap_retrieve_guides")
+# join: propose_gaps waits for both branches
+graph_builder.add_edge(["gap_collect_inputs", "gap_retrieve_guides"], "gap_propose_gaps")
 graph_builder.add_edge("gap_propose_gaps", "gap_propose_rqs")
 graph_builder.add_edge("gap_propose_rqs", "gap_format_answer")
 graph_builder.add_edge("gap_format_answer", END)
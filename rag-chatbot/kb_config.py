@@ -0,0 +1,20 @@
+# kb_config.py
+#
+# Settings of the static KB collection in Chroma, shared by the app
+# (rag_tools) and scripts/import_embeddings_to_chroma_server.py, which
+# creates the collection. Free of other imports so the script can use it
+# without the app's dependencies and API keys.
+
+# HNSW settings; fixed at creation time, a change needs a re-import.
+# - cosine: ranks by direction, so unit vectors (/api/embed) and raw
+#   vectors (/api/embeddings) of the same text match
+# - M / construction_ef: denser graph and more build-time candidates give
+#   better recall at the cost of RAM and import time
+# - search_ef: candidates per query; higher means better recall, slower
+#   queries (must stay >= n_results)
+KB_HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64,
+}
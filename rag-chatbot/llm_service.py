@@ -1,14 +1,22 @@
 # llm_service.py
 
+import asyncio
 import os
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
 
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 # Make sure .env is loaded as soon as this module is imported
 load_dotenv()
 
+BFH_LLM_BASE_URL = "https://inference.mlmp.ti.bfh.ch/api"
+BFH_LLM_MODEL = "ollama/gpt-oss:120b"
+# upper bound on concurrent async requests to the BFH endpoint
+BFH_LLM_CONCURRENCY = int(os.getenv("BFH_LLM_CONCURRENCY", "8"))
+
 
 class LLMService:
     def __init__(self):
@@ -20,11 +28,32 @@ class LLMService:
                 "API key not found. Make sure .env exists and contains BFH_LLM_API_KEY"
             )
 
+        # HTTP/2 multiplexes the per-turn calls over one TLS connection that
+        # is kept warm between turns. The read timeout stays at the OpenAI
+        # default: full-paper summaries can take minutes.
+        limits = httpx.Limits(
+            max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0
+        )
+        timeout = httpx.Timeout(600.0, connect=5.0)
+
+        # sync client for thread-based callers (paper summaries)
         self.client = OpenAI(
-            base_url="https://inference.mlmp.ti.bfh.ch/api",
+            base_url=BFH_LLM_BASE_URL,
+            api_key=api_key,
+            http_client=httpx.Client(http2=True, limits=limits, timeout=timeout),
+        )
+        # async client for the graph nodes; like rag_tools.ASYNC_HTTP it is
+        # bound to rag_tools' shared event loop, where the graphs run
+        self.aclient = AsyncOpenAI(
+            base_url=BFH_LLM_BASE_URL,
             api_key=api_key,
+            http_client=httpx.AsyncClient(http2=True, limits=limits, timeout=timeout),
         )
 
+        # The OpenAI client already retries 429/5xx with exponential backoff
+        # (max_retries); the semaphore keeps gathered calls from tripping it.
+        self._sem = asyncio.Semaphore(BFH_LLM_CONCURRENCY)
+
         print("✓ LLM Service initialized successfully!")
 
     def generate_completion(
@@ -32,21 +61,69 @@ class LLMService:
         system_prompt: str,
         user_prompt: str,
         temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
     ) -> Dict[str, Any]:
         response = self.client.chat.completions.create(
-            model="ollama/gpt-oss:120b",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            model=BFH_LLM_MODEL,
+            messages=_messages(system_prompt, user_prompt),
             temperature=temperature,
+            **_limits(max_tokens),
         )
+        return _as_result(response)
+
+    async def agenerate_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Async variant of generate_completion; same return shape."""
+        async with self._sem:
+            response = await self.aclient.chat.completions.create(
+                model=BFH_LLM_MODEL,
+                messages=_messages(system_prompt, user_prompt),
+                temperature=temperature,
+                **_limits(max_tokens),
+            )
+        return _as_result(response)
+
+
+def _messages(system_prompt: str, user_prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _limits(max_tokens: Optional[int]) -> Dict[str, Any]:
+    # gpt-oss is a reasoning model: its hidden reasoning tokens count against
+    # max_tokens, so callers should only cap it generously (or not at all).
+    extra: Dict[str, Any] = {}
+    if max_tokens is not None:
+        extra["max_tokens"] = max_tokens
+    return extra
+
+
+def _as_result(response) -> Dict[str, Any]:
+    return {
+        "text": (response.choices[0].message.content or "").strip(),
+        "model": response.model,
+        "usage": response.usage,
+    }
+
 
-        return {
-            "text": response.choices[0].message.content.strip(),
-            "model": response.model,
-            "usage": response.usage,
-        }
+@lru_cache(maxsize=1)
+def get_llm_service() -> LLMService:
+    """
+    The shared LLMService, created on first use; importing this module no
+    longer needs BFH_LLM_API_KEY or builds any HTTP clients.
+    """
+    return LLMService()
 
 
-llm_service = LLMService()
+def __getattr__(name: str):
+    # keeps `from llm_service import llm_service` working for old callers
+    if name == "llm_service":
+        return get_llm_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
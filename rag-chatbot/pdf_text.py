@@ -0,0 +1,32 @@
+# pdf_text.py
+#
+# PDF text extraction for uploaded papers. Kept free of the app's heavy
+# imports (Chroma, HTTP clients) so worker processes start quickly.
+
+from typing import Optional
+
+import fitz  # PyMuPDF
+
+
+def extract_full_text(data: bytes, max_chars: Optional[int] = None) -> str:
+    """
+    Read the PDF (bytes) and return plain text from its pages.
+
+    With `max_chars`, pages are only read until the text is that long; the
+    caller trims the result to its exact token budget.
+    """
+    pages = []
+    size = 0
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        for page in doc:
+            pages.append(page.get_text("text", flags=fitz.TEXTFLAGS_TEXT))
+            size += len(pages[-1]) + 2
+            # everything after this point would be cut off anyway
+            if (
+                max_chars is not None
+                and size > max_chars
+                and len("\n\n".join(pages).strip()) >= max_chars
+            ):
+                break
+
+    return "\n\n".join(pages).strip()
@@ -1,5 +1,8 @@
 # prompts.py
 
+import os
+from functools import lru_cache
+
 RAG_SAFETY_PREAMBLE = """You are an assistant in a Retrieval-Augmented Generation (RAG) app.
 
 You MUST:
@@ -46,3 +49,59 @@ PERSONA_MAP = {
         ),
     },
 }
+
+
+@lru_cache(maxsize=16)
+def persona_header(
+    mode: str, persona: str, default_mode: str = "Research question helper"
+) -> str:
+    """
+    The "Mode / Instruction / Persona" block used by the answer prompts,
+    composed once per (mode, persona) instead of on every turn.
+    """
+    mode_instr = MODE_INSTR.get(mode, MODE_INSTR[default_mode])
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
+    return (
+        f"Mode: {mode}. Instruction: {mode_instr}\n"
+        f"Persona: {persona} — {style['instr']}"
+    )
+
+
+def prompt_template(static_prefix: str, trailer: str) -> str:
+    """
+    Join a static prompt prefix and a `str.format` trailer into one
+    module-level template. Braces in the prefix are escaped; values passed
+    to format_map() are inserted verbatim, braces included.
+    """
+    return static_prefix.replace("{", "{{").replace("}", "}}") + trailer
+
+
+# Token budgeting. Neither model's tokenizer (Mixtral via Together, gpt-oss
+# via BFH) ships with the app, so lengths are estimated from characters;
+# 3.5 chars/token fits English/German prose.
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3.5"))
+# Token-dense text (German compounds, tables, reference lists) runs above
+# the estimate, so budgets leave this share of the context window unused.
+TOKEN_BUDGET_MARGIN = float(os.getenv("TOKEN_BUDGET_MARGIN", "0.1"))
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def usable_context(context_tokens: int) -> int:
+    """The part of a context window that estimated prompt text may fill."""
+    return int(context_tokens * (1 - TOKEN_BUDGET_MARGIN))
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Cut `text` to about `budget` tokens, at a paragraph or word break."""
+    max_chars = max(int(budget * CHARS_PER_TOKEN), 0)
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    for sep in ("\n\n", "\n", " "):
+        pos = cut.rfind(sep)
+        if pos > max_chars * 0.8:
+            return cut[:pos].rstrip()
+    return cut
@@ -1,12 +1,14 @@
 # proposal_graph_config.py
 
 # this is just a placeholder to test you can put whatever you want :)
+from functools import lru_cache
 from typing import TypedDict
 
 from langgraph.graph import StateGraph, END
+from langgraph.types import StreamWriter
 
-from prompts import RAG_SAFETY_PREAMBLE, MODE_INSTR, PERSONA_MAP
-from rag_tools import llm_complete
+from prompts import RAG_SAFETY_PREAMBLE, PERSONA_MAP, persona_header
+from rag_tools import llm_complete_streaming
 
 
 class ProposalState(TypedDict):
@@ -19,33 +21,35 @@ class ProposalState(TypedDict):
     answer: str
 
 
-def proposal_refine_node(state: ProposalState) -> ProposalState:
-    """
-    Single-node proposal refinement agent.
+# static instructions first, so consecutive prompts share the longest prefix
+PROPOSAL_REFINE_PREFIX = f"""{RAG_SAFETY_PREAMBLE}
 
-    Used when the user selects "Proposal refinement assistant" in the UI.
-    It does NOT use RAG yet – just the LLM – so your teammate can
-    later expand this into a full graph if needed.
-    """
-    user_msg = state["question"]
-    mode = state.get("mode", "Proposal refinement assistant")
-    persona = state.get("persona", "Helper")
-    summary = state.get("summary", "")
-    recent_qas = state.get("recent_qas", "None")
+You are a BFH thesis PROPOSAL refinement assistant.
 
-    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
-    mode_instr = MODE_INSTR.get(
-        "Proposal refinement assistant",
-        MODE_INSTR["Proposal refinement assistant"],
-    )
+TASK:
+1. First, restate your understanding of the student's planned thesis (given below) in 2–3 bullet points.
+2. Then give feedback under these headings:
+   - Strengths
+   - Weaknesses / risks
+   - Suggestions to refine the research question
+   - Suggestions to refine methods / data
+3. Keep it concrete, realistic, and feasible for a BFH bachelor thesis.
+4. If the student only writes a very short idea, intelligently suggest 1–2 clearer,
+   more precise versions of their proposal.
 
-    prompt = f"""{RAG_SAFETY_PREAMBLE}
+Return a clear markdown answer with these headings and bullet points.
+"""
 
-You are a BFH thesis PROPOSAL refinement assistant.
 
-Mode: {mode}. Instruction: {mode_instr}
-Persona: {persona} — {style["instr"]}
+@lru_cache(maxsize=16)
+def _proposal_system_prompt(mode: str, persona: str) -> str:
+    # static part: instructions + persona block, identical across turns
+    header = persona_header(mode, persona, "Proposal refinement assistant")
+    return f"{PROPOSAL_REFINE_PREFIX}\n{header}\n"
+
 
+# dynamic part: only what changes from turn to turn
+PROPOSAL_REFINE_USER_TMPL = """
 [Session summary]
 {summary}
 
@@ -54,22 +58,35 @@ Persona: {persona} — {style["instr"]}
 
 [Student's message about their proposal]
 {user_msg}
+"""
 
-TASK:
-1. First, restate your understanding of the student's planned thesis in 2–3 bullet points.
-2. Then give feedback under these headings:
-   - Strengths
-   - Weaknesses / risks
-   - Suggestions to refine the research question
-   - Suggestions to refine methods / data
-3. Keep it concrete, realistic, and feasible for a BFH bachelor thesis.
-4. If the student only writes a very short idea, intelligently suggest 1–2 clearer,
-   more precise versions of their proposal.
 
-Return a clear markdown answer with these headings and bullet points.
-"""
+def proposal_refine_node(state: ProposalState, writer: StreamWriter) -> ProposalState:
+    """
+    Single-node proposal refinement agent.
+
+    Used when the user selects "Proposal refinement assistant" in the UI.
+    It does NOT use RAG yet – just the LLM – so your teammate can
+    later expand this into a full graph if needed.
+    """
+    user_msg = state["question"]
+    mode = state.get("mode", "Proposal refinement assistant")
+    persona = state.get("persona", "Helper")
+    summary = state.get("summary", "")
+    recent_qas = state.get("recent_qas", "None")
+
+    style = PERSONA_MAP.get(persona, PERSONA_MAP["Helper"])
 
-    answer = llm_complete(prompt, max_tokens=900, temperature=style["temp"])
+    system_prompt = _proposal_system_prompt(mode, persona)
+    user_prompt = PROPOSAL_REFINE_USER_TMPL.format_map(
+        {"summary": summary, "recent_qas": recent_qas, "user_msg": user_msg}
+    )
+
+    # Together's completions endpoint has no roles; the static system part
+    # still leads, so consecutive prompts share it as a prefix.
+    answer = llm_complete_streaming(
+        system_prompt + user_prompt, writer, max_tokens=900, temperature=style["temp"]
+    )
     state["answer"] = answer
     state["task"] = "proposal_refine"
     return state
@@ -5,31 +5,34 @@
 """
 Tools used by the Proposal refinement agent.
 
-Right now this module is very small and mostly wraps the generic LLM call.
+Right now this module is very small and mostly wraps the BFH LLM call.
 Your teammate can extend it later with:
 - RAG over Creswell / BFH docs,
 - calls to your paper summaries, etc.
 """
 
-from typing import Dict, Any
-from rag_tools import llm_complete  # reuse same Together LLM for now
+from typing import Dict, Any, Optional
+
+from llm_service import get_llm_service
 
 
 def proposal_llm(
     system_prompt: str,
     user_prompt: str,
     temperature: float = 0.2,
-    max_tokens: int = 900,
+    max_tokens: Optional[int] = None,
 ) -> Dict[str, Any]:
     """
     Simple helper that your anna can use.
 
-    It returns a dict so it's easy to extend later if needed.
+    Sends system and user prompt as separate chat messages to the BFH LLM,
+    so the static system prompt is not re-glued to every request. Returns
+    the service's {"text", "model", "usage"} dict. gpt-oss spends reasoning
+    tokens from max_tokens, so only cap it generously.
     """
-    prompt = f"{system_prompt.strip()}\n\n{user_prompt.strip()}"
-    text = llm_complete(prompt, max_tokens=max_tokens, temperature=temperature)
-    return {
-        "text": text,
-        "model": "proposal/llm_complete",  # just a tag
-        "usage": {},                      # can be filled later if you track usage
-    }
+    return get_llm_service().generate_completion(
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
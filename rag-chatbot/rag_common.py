@@ -0,0 +1,76 @@
+# rag_common.py
+#
+# Helpers shared by the Streamlit front-end: text cleanup for model output
+# and the per-session state defaults. Patterns are compiled once at import.
+
+import re
+import uuid
+from typing import Any, Callable, Dict, MutableMapping
+
+from rag_tools import llm_complete  # re-exported for the UI modules
+
+__all__ = [
+    "llm_complete",
+    "SELF_REF_RE",
+    "PROMPTY_RE",
+    "NEWLINES_RE",
+    "_clean_text",
+    "init_session_state",
+]
+
+SELF_REF_RE = re.compile(
+    r"\[Self-Reflection Checklist\].*?(?:\Z|\n{2,})",
+    re.IGNORECASE | re.DOTALL,
+)
+PROMPTY_RE = re.compile(
+    r"\[Write (?:the )?updated summary below\]\s*",
+    re.IGNORECASE,
+)
+NEWLINES_RE = re.compile(r"\n{3,}")
+
+
+def _clean_text(text: str) -> str:
+    if not text:
+        return ""
+    # Both bracket patterns are case-insensitive, so gate them on a
+    # lowercased copy; plain answers without "[" skip the regexes entirely.
+    if "[" in text:
+        lowered = text.lower()
+        if "[self-reflection checklist]" in lowered:
+            text = SELF_REF_RE.sub("", text)
+        if "[write " in lowered:
+            text = PROMPTY_RE.sub("", text)
+    if "\n\n\n" in text:
+        text = NEWLINES_RE.sub("\n\n", text)
+    return text.strip()
+
+
+# key -> factory; factories keep mutable defaults from being shared
+_SESSION_DEFAULTS: Dict[str, Callable[[], Any]] = {
+    "history": list,
+    "summary": str,
+    # "Q: ...\nA: ..." blocks of the last MAX_RECENT_TURNS turns, rebuilt on submit
+    "recent_qas_text": str,
+    "recent_sources": list,
+    "mode": lambda: "Research question helper",
+    "persona": lambda: "Helper",
+    # kept for backward compatibility / tracing
+    "upload_collection_name": lambda: f"user_uploads_{uuid.uuid4().hex[:8]}",
+    # summaries of uploaded papers
+    "paper_summaries": dict,
+    # canonical concatenation of paper_summaries, rebuilt when they change
+    "gap_paper_summaries": str,
+    "summarized_paper_count": int,
+    "last_task": lambda: "(none)",
+    # index into history up to which turns are already merged into the summary
+    "last_summarized_index": int,
+    # Future of a memory summary running in the background (or None)
+    "pending_summary": lambda: None,
+}
+
+
+def init_session_state(state: MutableMapping[str, Any]) -> None:
+    """Fill in any missing session keys (pass st.session_state)."""
+    for key, factory in _SESSION_DEFAULTS.items():
+        if key not in state:
+            state[key] = factory()
@@ -1,15 +1,39 @@
 # rag_tools.py
 
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
 import os
+import threading
 import time
-from typing import List, Dict, Any
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 import chromadb
-import fitz  # PyMuPDF
 from dotenv import load_dotenv
 
-from llm_service import llm_service  # <-- BFH LLM wrapper
+from kb_config import KB_HNSW_METADATA  # shared with the import script
+from llm_service import get_llm_service  # <-- BFH LLM wrapper
+from pdf_text import extract_full_text
+from prompts import (
+    CHARS_PER_TOKEN,
+    estimate_tokens,
+    truncate_to_tokens,
+    usable_context,
+)
 
 load_dotenv()
 
@@ -22,11 +46,16 @@ if not TOGETHER_API_KEY:
     raise ValueError("Bitte TOGETHER_API_KEY als Umgebungsvariable setzen.")
 
 MIXTRAL_MODEL = os.getenv("LLM_MODEL", "mistralai/Mixtral-8x7B-Instruct-v0.1")
+TOGETHER_COMPLETIONS_URL = "https://api.together.xyz/v1/completions"
 
 # Embeddings for STATIC KB (Creswell / BFH docs)
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
-EMBEDDING_URL = os.getenv("EMBEDDING_URL", "http://ollama:11434/api/embeddings")
 OLLAMA_BASE = os.getenv("OLLAMA_BASE", "http://ollama:11434")
+# batch endpoint: {"input": [...]} -> {"embeddings": [[...], ...]}
+EMBED_BATCH_URL = os.getenv("EMBED_BATCH_URL", f"{OLLAMA_BASE}/api/embed")
+# legacy endpoint (raw vectors), only for KB collections imported before
+# the switch to cosine; see _kb_query_embedding
+EMBEDDING_URL = os.getenv("EMBEDDING_URL", f"{OLLAMA_BASE}/api/embeddings")
 EMBED_FALLBACKS = [
     m.strip()
     for m in os.getenv("EMBED_FALLBACKS", "mxbai-embed-large,all-minilm").split(",")
@@ -38,6 +67,60 @@ CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
 CHROMA_KB_COLLECTION = os.getenv("CHROMA_COLLECTION", "gesetzestexte")
 
 
+def _make_http_session() -> requests.Session:
+    """
+    Shared keep-alive session for Together and Ollama calls, so repeated
+    requests reuse pooled TCP/TLS connections instead of reconnecting.
+    """
+    session = requests.Session()
+    # Only failed connects are retried (e.g. Ollama still starting up);
+    # Together's 429/5xx handling stays with the tenacity policy below.
+    retries = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+HTTP_SESSION = _make_http_session()
+
+# Async counterpart for the graph nodes. An httpx.AsyncClient is bound to the
+# event loop it first runs on, so all coroutines using it go through the one
+# long-lived loop below (run_async / submit_async). Together (HTTPS)
+# negotiates HTTP/2; Ollama is plain HTTP/1.1, where concurrency comes from
+# the connection pool.
+ASYNC_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=120,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Start (once) and return the process-wide event loop thread."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="rag-async", daemon=True
+            ).start()
+        return _loop
+
+
+def submit_async(coro) -> "concurrent.futures.Future":
+    """Schedule `coro` on the shared loop from sync code; returns a Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop())
+
+
+def run_async(coro):
+    """Run `coro` on the shared loop and block until it finishes."""
+    return submit_async(coro).result()
+
+
 # --------------------------------------------------------------------
 # LLM (Together / Mixtral) for router, methods & gap pipelines
 # --------------------------------------------------------------------
@@ -47,9 +130,82 @@ def llm_complete(prompt: str, max_tokens: int = 1024, temperature: float = 0.2)
     Call Together's completion endpoint with the configured MIXTRAL_MODEL.
 
     Used by the LangGraph pipelines (router, methods, gap, memory summariser).
+    Deterministic calls (temperature 0) are memoised per process, so a
+    repeated prompt does not hit the API again.
+    """
+    if temperature == 0.0:
+        return _llm_complete_cached(prompt, max_tokens, temperature)
+    return _llm_complete_uncached(prompt, max_tokens, temperature)
+
+
+@lru_cache(maxsize=1024)
+def _llm_complete_cached(prompt: str, max_tokens: int, temperature: float) -> str:
+    return _llm_complete_uncached(prompt, max_tokens, temperature)
+
+
+class LLMRateLimited(RuntimeError):
+    """Together answered 429/503; the call is retried with backoff."""
+
+
+# upper bound on concurrent Together requests from the async paths
+TOGETHER_CONCURRENCY = int(os.getenv("TOGETHER_CONCURRENCY", "8"))
+_together_sem = asyncio.Semaphore(TOGETHER_CONCURRENCY)
+# requests per minute allowed by the Together account tier (0 = no limit)
+TOGETHER_RPM = int(os.getenv("TOGETHER_RPM", "600"))
+
+
+class _RateLimiter:
+    """
+    Token bucket for the async Together calls: `rate` requests per minute,
+    with bursts of up to `burst`. Like the semaphore it is only used on the
+    shared event loop.
     """
-    resp = requests.post(
-        "https://api.together.xyz/v1/completions",
+
+    def __init__(self, rate: int, burst: int):
+        self.per_second = rate / 60.0
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.per_second <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._stamp) * self.per_second
+                )
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.per_second)
+
+
+_together_rate = _RateLimiter(TOGETHER_RPM, burst=TOGETHER_CONCURRENCY)
+
+_llm_retry = retry(
+    retry=retry_if_exception_type(LLMRateLimited),
+    wait=wait_exponential_jitter(initial=0.5, max=8.0),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+
+
+def _completion_text(status_code: int, body: str, payload) -> str:
+    if status_code in (429, 503):
+        raise LLMRateLimited(f"LLM error: {status_code} — {body}")
+    if status_code != 200:
+        raise RuntimeError(f"LLM error: {status_code} — {body}")
+    return payload().get("choices", [{}])[0].get("text", "").strip()
+
+
+@_llm_retry
+def _llm_complete_uncached(prompt: str, max_tokens: int, temperature: float) -> str:
+    resp = HTTP_SESSION.post(
+        TOGETHER_COMPLETIONS_URL,
         headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
         json={
             "model": MIXTRAL_MODEL,
@@ -59,9 +215,86 @@ def llm_complete(prompt: str, max_tokens: int = 1024, temperature: float = 0.2)
         },
         timeout=60,
     )
-    if resp.status_code != 200:
-        raise RuntimeError(f"LLM error: {resp.status_code} — {resp.text}")
-    return resp.json().get("choices", [{}])[0].get("text", "").strip()
+    return _completion_text(resp.status_code, resp.text, resp.json)
+
+
+@_llm_retry
+async def allm_complete(
+    prompt: str, max_tokens: int = 1024, temperature: float = 0.2
+) -> str:
+    """
+    Async variant of llm_complete on the shared ASYNC_HTTP client, so several
+    completions can be awaited concurrently (asyncio.gather) from one node.
+
+    At most TOGETHER_CONCURRENCY requests are in flight and at most
+    TOGETHER_RPM are started per minute; the slot is released before a
+    rate-limit backoff, not held through it.
+    """
+    async with _together_sem:
+        await _together_rate.acquire()
+        resp = await ASYNC_HTTP.post(
+            TOGETHER_COMPLETIONS_URL,
+            headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
+            json={
+                "model": MIXTRAL_MODEL,
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+            },
+            timeout=60,
+        )
+    return _completion_text(resp.status_code, resp.text, resp.json)
+
+
+def llm_stream(
+    prompt: str, max_tokens: int = 1024, temperature: float = 0.2
+) -> Iterator[str]:
+    """
+    Like llm_complete, but with "stream": true; yields the text chunks as
+    Together sends them (server-sent events).
+    """
+    with HTTP_SESSION.post(
+        TOGETHER_COMPLETIONS_URL,
+        headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
+        json={
+            "model": MIXTRAL_MODEL,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+        },
+        timeout=60,
+        stream=True,
+    ) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"LLM error: {resp.status_code} — {resp.text}")
+        for line in resp.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                break
+            choices = json.loads(data).get("choices") or [{}]
+            text = choices[0].get("text")
+            if text:
+                yield text
+
+
+def llm_complete_streaming(
+    prompt: str,
+    on_chunk: Callable[[str], None],
+    max_tokens: int = 1024,
+    temperature: float = 0.2,
+) -> str:
+    """
+    Stream a completion, passing every chunk to `on_chunk` as it arrives
+    (e.g. a LangGraph stream writer), and return the full text.
+    """
+    parts: List[str] = []
+    for chunk in llm_stream(prompt, max_tokens=max_tokens, temperature=temperature):
+        parts.append(chunk)
+        on_chunk(chunk)
+    return "".join(parts).strip()
 
 
 # --------------------------------------------------------------------
@@ -70,7 +303,7 @@ def llm_complete(prompt: str, max_tokens: int = 1024, temperature: float = 0.2)
 
 def ollama_pull(model_name: str):
     try:
-        r = requests.post(
+        r = HTTP_SESSION.post(
             f"{OLLAMA_BASE}/api/pull",
             json={"name": model_name},
             timeout=600,
@@ -91,97 +324,396 @@ def ensure_embedding_model(model_name: str) -> str:
     return model_name
 
 
-def embed_text_ollama(text: str) -> List[float]:
+def ollama_loaded_models() -> List[str]:
+    """Names of the models Ollama currently holds in memory (/api/ps)."""
+    try:
+        r = HTTP_SESSION.get(f"{OLLAMA_BASE}/api/ps", timeout=5)
+        r.raise_for_status()
+        return [m.get("name", "") for m in r.json().get("models", [])]
+    except Exception:
+        return []
+
+
+def warm_embedding_model() -> bool:
     """
-    Embed text via the local Ollama embedding endpoint.
-    Used for querying the static Creswell/BFH KB in Chroma.
+    Make sure EMBEDDING_MODEL is resident in Ollama before the first query,
+    so no user request pays for the cold load (or the pull).
     """
-    global EMBEDDING_MODEL
+    loaded = ollama_loaded_models()
+    base = EMBEDDING_MODEL.split(":")[0]
+    if any(name.split(":")[0] == base for name in loaded):
+        print(f"Ollama: {EMBEDDING_MODEL} resident (loaded: {', '.join(loaded)})")
+        return True
+    try:
+        embed_texts_ollama(["warm-up"])  # loads (and if needed pulls) the model
+    except Exception as e:
+        print(f"Ollama: could not load {EMBEDDING_MODEL}: {e}")
+        return False
+    print(f"Ollama: loaded {EMBEDDING_MODEL}")
+    return True
 
-    def _embed(model):
-        r = requests.post(
-            EMBEDDING_URL,
-            json={"model": model, "prompt": text},
-            timeout=120,
-        )
-        return r
 
-    r = _embed(EMBEDDING_MODEL)
+def _embed_with_fallbacks(post, parse):
+    """
+    Run an embedding request, pulling the model or switching to one of
+    EMBED_FALLBACKS when Ollama reports the configured model as missing.
+
+    `post(model)` sends the request, `parse(response)` extracts the result.
+    """
+    global EMBEDDING_MODEL
+
+    r = post(EMBEDDING_MODEL)
     if r.status_code == 200:
-        return r.json().get("embedding")
+        return parse(r)
     if r.status_code == 404 and "not found" in r.text.lower():
         chosen = ensure_embedding_model(EMBEDDING_MODEL)
-        r2 = _embed(chosen)
+        r2 = post(chosen)
         if r2.status_code == 200:
             EMBEDDING_MODEL = chosen
-            return r2.json().get("embedding")
+            return parse(r2)
         for alt in EMBED_FALLBACKS:
-            r3 = _embed(alt)
+            r3 = post(alt)
             if r3.status_code == 200:
                 EMBEDDING_MODEL = alt
-                return r3.json().get("embedding")
+                return parse(r3)
     raise RuntimeError(f"Embedding error: {r.status_code} — {r.text}")
 
 
+# Query embeddings, shared by the sync and async paths: the router, the KB
+# lookups and retries often embed the same question more than once per turn.
+# Values are tuples so no caller can mutate a cached vector.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "1024"))
+_embed_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+
+def _embed_cache_get(text: str) -> Optional[List[float]]:
+    key = (EMBEDDING_MODEL, text)
+    with _embed_cache_lock:
+        hit = _embed_cache.get(key)
+        if hit is None:
+            return None
+        _embed_cache.move_to_end(key)
+    return list(hit)
+
+
+def _embed_cache_put(text: str, vec: List[float]) -> None:
+    # keyed by the model that produced it (a fallback switch changes it)
+    with _embed_cache_lock:
+        _embed_cache[(EMBEDDING_MODEL, text)] = tuple(vec)
+        while len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+
+
+def _split_cached(texts: List[str]):
+    """Cached vectors by position (None = miss), plus the distinct misses."""
+    vecs = [_embed_cache_get(t) for t in texts]
+    missing = list(dict.fromkeys(t for t, v in zip(texts, vecs) if v is None))
+    return vecs, missing
+
+
+def _merge_embedded(texts, vecs, missing, embedded) -> List[List[float]]:
+    # a short or partly empty reply would otherwise surface as a None vector
+    # far away, in the cache or in Chroma's query
+    if not embedded or len(embedded) != len(missing) or not all(embedded):
+        got = len(embedded) if embedded else 0
+        raise RuntimeError(
+            f"Embedding error: {got} vectors for {len(missing)} inputs"
+        )
+    fresh = dict(zip(missing, embedded))
+    for t, v in fresh.items():
+        _embed_cache_put(t, v)
+    return [v if v is not None else fresh[t] for t, v in zip(texts, vecs)]
+
+
+def _embed_payload(model: str, texts: List[str]) -> Dict[str, Any]:
+    return {"model": model, "input": list(texts)}
+
+
+def embed_text_ollama(text: str) -> List[float]:
+    """
+    Embed text via the local Ollama embedding endpoint.
+    Used for querying the static Creswell/BFH KB in Chroma.
+    """
+    return embed_texts_ollama([text])[0]
+
+
+def embed_texts_ollama(texts: List[str]) -> List[List[float]]:
+    """
+    Embed several texts with a single request to Ollama's /api/embed.
+
+    One HTTP round-trip and one model pass for the whole batch instead of
+    one per text; /api/embed returns unit vectors, which the cosine KB
+    collection expects. Vectors are memoised per (model, text) in a bounded
+    LRU shared with the async variants, and only misses are sent.
+    """
+    vecs, missing = _split_cached(texts)
+    if not missing:
+        return vecs
+    embedded = _embed_with_fallbacks(
+        lambda model: HTTP_SESSION.post(
+            EMBED_BATCH_URL, json=_embed_payload(model, missing), timeout=120
+        ),
+        lambda r: r.json().get("embeddings"),
+    )
+    return _merge_embedded(texts, vecs, missing, embedded)
+
+
+async def aembed_text_ollama(text: str) -> List[float]:
+    """Async variant of embed_text_ollama for the async graph nodes."""
+    return (await aembed_texts_ollama([text]))[0]
+
+
+async def aembed_texts_ollama(texts: List[str]) -> List[List[float]]:
+    """
+    Async variant of embed_texts_ollama (same endpoint, same cache).
+
+    The common case is one non-blocking POST; anything else (missing model,
+    fallbacks) is handed to the sync implementation in a worker thread.
+    """
+    vecs, missing = _split_cached(texts)
+    if not missing:
+        return vecs
+    r = await ASYNC_HTTP.post(
+        EMBED_BATCH_URL, json=_embed_payload(EMBEDDING_MODEL, missing)
+    )
+    if r.status_code != 200:
+        return await asyncio.to_thread(embed_texts_ollama, texts)
+    return _merge_embedded(texts, vecs, missing, r.json().get("embeddings"))
+
+
 # -------- Chroma helpers (static KB only) -------- #
 
-def get_chroma_client(max_attempts: int = 10, delay: float = 2.0):
+CHROMA_CONNECT_DEADLINE = float(os.getenv("CHROMA_CONNECT_DEADLINE", "5.0"))
+# after a failed connect, further attempts fail fast for this many seconds
+CHROMA_BREAKER_COOLDOWN = float(os.getenv("CHROMA_BREAKER_COOLDOWN", "10.0"))
+# monotonic time of the last failed connect; None until one has happened
+_chroma_last_failure: Optional[float] = None
+
+
+def get_chroma_client(
+    max_attempts: int = 10,
+    delay: float = 0.1,
+    deadline: float = CHROMA_CONNECT_DEADLINE,
+):
     """
     Connect to ChromaDB (used only for the static methods KB).
+
+    Retries back off exponentially (delay, 2*delay, ... capped at 4 s) until
+    `deadline` seconds have passed. If Chroma was unreachable within the last
+    CHROMA_BREAKER_COOLDOWN seconds the call raises right away instead of
+    blocking another request on the same outage.
     """
+    global _chroma_last_failure
+    if _chroma_last_failure is not None:
+        since_failure = time.monotonic() - _chroma_last_failure
+        if since_failure < CHROMA_BREAKER_COOLDOWN:
+            raise ConnectionError(
+                f"Chroma at {CHROMA_HOST}:{CHROMA_PORT} unreachable "
+                f"{since_failure:.1f}s ago; not retrying yet"
+            )
+
+    start = time.monotonic()
     for attempt in range(max_attempts):
         try:
             client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
             client.heartbeat()
             return client
         except Exception:
-            if attempt == max_attempts - 1:
+            pause = min(delay * 2 ** attempt, 4.0)
+            if (
+                attempt == max_attempts - 1
+                or time.monotonic() - start + pause > deadline
+            ):
+                _chroma_last_failure = time.monotonic()
                 raise
-            time.sleep(delay)
+            time.sleep(pause)
 
 
-def retrieve_kb_context(question: str, n_results: int = 5):
+@lru_cache(maxsize=1)
+def _shared_chroma_client():
     """
-    Retrieve from the static Creswell / BFH methods knowledge base.
+    Process-wide Chroma client; the connect/heartbeat retry loop only runs
+    on first use (a failed attempt is not cached and is retried next call).
+    """
+    return get_chroma_client()
 
-    This is vector-based (Chroma) but only for the fixed KB docs,
-    not for user-uploaded PDFs.
+
+@lru_cache(maxsize=1)
+def _kb_collection():
+    """
+    Process-wide handle of the KB collection, so a query is one round-trip
+    instead of two. An existing collection is returned as is; the metadata
+    only applies when the KB has not been imported yet.
+    """
+    collection = _shared_chroma_client().get_or_create_collection(
+        CHROMA_KB_COLLECTION, metadata=KB_HNSW_METADATA
+    )
+    if not _is_cosine(collection):
+        print(
+            f"Chroma: collection {CHROMA_KB_COLLECTION!r} is not cosine; "
+            "querying it with raw /api/embeddings vectors until it is re-imported"
+        )
+    return collection
+
+
+def _is_cosine(collection) -> bool:
+    return (collection.metadata or {}).get("hnsw:space") == "cosine"
+
+
+def _kb_uses_unit_vectors() -> bool:
+    # Collections from older imports are l2 (Chroma's default) over raw
+    # vectors of norm ~18; unit query vectors would rank them wrongly.
+    return _is_cosine(_kb_collection())
+
+
+def embed_text_ollama_raw(text: str) -> List[float]:
+    """
+    Embed text on the legacy /api/embeddings endpoint (raw, unnormalised
+    vector), matching the vectors of a pre-cosine KB import. Not cached:
+    the KB result cache already covers repeated questions.
     """
-    q_emb = embed_text_ollama(question)
-    client = get_chroma_client()
-    collection = client.get_or_create_collection(CHROMA_KB_COLLECTION)
+    vec = _embed_with_fallbacks(
+        lambda model: HTTP_SESSION.post(
+            EMBEDDING_URL, json={"model": model, "prompt": text}, timeout=120
+        ),
+        lambda r: r.json().get("embedding"),
+    )
+    if not vec:
+        raise RuntimeError("Embedding error: empty vector")
+    return vec
+
+
+def _query_kb_collection(q_emb: List[float], n_results: int):
+    try:
+        return _query_kb(_kb_collection(), q_emb, n_results)
+    except Exception:
+        # A re-import replaces the collection; retry once with a new handle.
+        _kb_collection.cache_clear()
+        return _query_kb(_kb_collection(), q_emb, n_results)
+
+
+def _query_kb(collection, q_emb: List[float], n_results: int):
     result = collection.query(
         query_embeddings=[q_emb],
         n_results=n_results,
-        include=["documents", "metadatas", "distances"],
+        # distances are never used; leaving them out trims every response
+        include=["documents", "metadatas"],
     )
     docs = result.get("documents", [[]])[0]
     metas = result.get("metadatas", [[]])[0]
     return docs, metas
 
 
+# The KB is static, so identical queries give identical hits; keep recent
+# results for KB_CACHE_TTL seconds (shared by the sync and async paths).
+KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", "600"))
+KB_CACHE_SIZE = 256
+_kb_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_kb_cache_lock = threading.Lock()
+
+
+def _kb_cache_get(key: tuple):
+    with _kb_cache_lock:
+        hit = _kb_cache.get(key)
+        if hit is None:
+            return None
+        stored_at, docs, metas = hit
+        if time.monotonic() - stored_at > KB_CACHE_TTL:
+            del _kb_cache[key]
+            return None
+        _kb_cache.move_to_end(key)
+    # copies, so callers may annotate the metadata dicts freely
+    return list(docs), [dict(m) for m in metas]
+
+
+def _kb_cache_put(key: tuple, docs, metas):
+    with _kb_cache_lock:
+        _kb_cache[key] = (time.monotonic(), list(docs), [dict(m) for m in metas])
+        _kb_cache.move_to_end(key)
+        while len(_kb_cache) > KB_CACHE_SIZE:
+            _kb_cache.popitem(last=False)
+
+
+def retrieve_kb_context(question: str, n_results: int = 5):
+    """
+    Retrieve from the static Creswell / BFH methods knowledge base.
+
+    This is vector-based (Chroma) but only for the fixed KB docs,
+    not for user-uploaded PDFs.
+    """
+    key = (question, n_results)
+    hit = _kb_cache_get(key)
+    if hit is not None:
+        return hit
+    if _kb_uses_unit_vectors():
+        q_emb = embed_text_ollama(question)
+    else:
+        q_emb = embed_text_ollama_raw(question)
+    docs, metas = _query_kb_collection(q_emb, n_results)
+    _kb_cache_put(key, docs, metas)
+    return docs, metas
+
+
+async def aretrieve_kb_context(question: str, n_results: int = 5):
+    """
+    Async variant of retrieve_kb_context.
+
+    The blocking Chroma query runs in a worker thread so the event loop
+    stays free.
+    """
+    key = (question, n_results)
+    hit = _kb_cache_get(key)
+    if hit is not None:
+        return hit
+    if await asyncio.to_thread(_kb_uses_unit_vectors):
+        q_emb = await aembed_text_ollama(question)
+    else:
+        q_emb = await asyncio.to_thread(embed_text_ollama_raw, question)
+    docs, metas = await asyncio.to_thread(_query_kb_collection, q_emb, n_results)
+    _kb_cache_put(key, docs, metas)
+    return docs, metas
+
+
 # --------------------------------------------------------------------
 # NEW: Full-paper summarization with BFH LLM (gpt-oss:120b)
 # --------------------------------------------------------------------
 
-def _extract_full_text_from_pdf(data: bytes) -> str:
-    """
-    Read the entire PDF (bytes) and return plain text from all pages.
+# PDF extraction is CPU-bound; uploads are parsed in separate processes.
+# The worker function lives in pdf_text, so workers import only PyMuPDF,
+# and forkserver keeps them from being forked off this multi-threaded one.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
 
-    A soft character cap is applied to keep within the BFH LLM context window.
-    """
-    with fitz.open(stream=data, filetype="pdf") as doc:
-        pages = [page.get_text() for page in doc]
 
-    full_text = "\n\n".join(pages).strip()
-    if not full_text:
-        return ""
+# Context window of the BFH model as served, and the part of it reserved for
+# the summary itself (gpt-oss's hidden reasoning included). The paper text
+# gets the rest; without its tokenizer, lengths are estimated (prompts.py)
+# and a TOKEN_BUDGET_MARGIN share of the window stays free. The endpoint
+# does not report its window: SUMMARY_CONTEXT_TOKENS must be set to the
+# num_ctx of the deployed gpt-oss, the default is only a conservative guess.
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("SUMMARY_CONTEXT_TOKENS", "12288"))
+SUMMARY_OUTPUT_TOKENS = int(os.getenv("SUMMARY_OUTPUT_TOKENS", "4096"))
+
+
+def _paper_text_budget(title: str) -> int:
+    system_prompt, user_prompt = _paper_summary_prompts(title, "")
+    used = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    return max(
+        usable_context(SUMMARY_CONTEXT_TOKENS) - SUMMARY_OUTPUT_TOKENS - used, 0
+    )
+
+
+def _fit_paper_text(title: str, full_text: str) -> str:
+    return truncate_to_tokens(full_text, _paper_text_budget(title))
+
 
-    # Safety cap: if the PDF is huge, truncate.
-    max_chars = int(os.getenv("SUMMARY_MAX_CHARS", "25000"))
-    if len(full_text) > max_chars:
-        full_text = full_text[:max_chars]
-    return full_text
+@lru_cache(maxsize=1)
+def _pdf_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Process pool for PDF text extraction, started on first use."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
 
 
 def summarize_single_paper_with_bfh_llm(title: str, full_text: str) -> str:
@@ -200,6 +732,26 @@ def summarize_single_paper_with_bfh_llm(title: str, full_text: str) -> str:
     if not full_text.strip():
         return f"## {title}\n\n(No readable text was extracted from this PDF.)"
 
+    resp = get_llm_service().generate_completion(
+        *_paper_summary_prompts(title, _fit_paper_text(title, full_text)),
+        temperature=0.0,  # deterministic for summaries
+    )
+    return resp["text"].strip()
+
+
+async def asummarize_single_paper_with_bfh_llm(title: str, full_text: str) -> str:
+    """Async variant of summarize_single_paper_with_bfh_llm (same prompts)."""
+    if not full_text.strip():
+        return f"## {title}\n\n(No readable text was extracted from this PDF.)"
+
+    resp = await get_llm_service().agenerate_completion(
+        *_paper_summary_prompts(title, _fit_paper_text(title, full_text)),
+        temperature=0.0,
+    )
+    return resp["text"].strip()
+
+
+def _paper_summary_prompts(title: str, full_text: str) -> Tuple[str, str]:
     system_prompt = (
         "You are an assistant that reads full academic papers for a thesis "
         "proposal assistant. Your job is to produce a structured, honest "
@@ -234,26 +786,85 @@ Write a markdown summary under the heading "## {title}" with the following subse
 If a subsection is not covered in the text, write "not specified in text" for that subsection.
 """
 
-    resp = llm_service.generate_completion(
-        system_prompt=system_prompt,
-        user_prompt=user_prompt,
-        temperature=0.0,  # deterministic for summaries
-    )
+    return system_prompt, user_prompt
 
-    return resp["text"].strip()
+
+def _with_heading(title: str, summary: str) -> str:
+    # Every stored summary starts with its "## <title>" heading, so the
+    # graphs can use it as a context block as-is.
+    text = summary.strip()
+    if not text.startswith("## "):
+        text = f"## {title}\n\n{text}"
+    return text
 
 
-def summarize_uploaded_papers(files) -> Dict[str, str]:
+class SummaryCache:
+    """
+    On-disk store of paper summaries, one file per key.
+
+    Summaries survive across sessions and restarts, so re-uploading the same
+    PDF skips text extraction and the BFH LLM call. Writes go through a
+    temporary file and os.replace(), which keeps concurrent readers safe.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key_for(title: str, data: bytes) -> str:
+        # The title is part of the key because it ends up in the summary heading.
+        h = hashlib.sha256(title.encode("utf-8"))
+        h.update(b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.md")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), encoding="utf-8") as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def set(self, key: str, summary: str) -> None:
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.write(summary)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            # A read-only or full disk only costs us the cache.
+            print(f"Could not cache summary {key[:12]}: {e}")
+
+
+# papers summarized at once; each call sends a whole paper to the BFH LLM
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+
+
+def summarize_uploaded_papers(
+    files, cache: Optional[SummaryCache] = None
+) -> Dict[str, str]:
     """
     Summarize each uploaded PDF with the BFH LLM.
 
+    Papers not found in the cache are summarized concurrently (at most
+    SUMMARY_CONCURRENCY at a time), so K new papers take about as long as
+    the slowest one instead of the sum of all. Rate-limit and server errors
+    are retried with backoff by the OpenAI client.
+
     Args:
         files: list of Streamlit UploadedFile-like objects.
+        cache: optional SummaryCache; papers already summarized (same title
+            and bytes) are served from it without calling the LLM.
 
     Returns:
         Dict mapping filename -> markdown summary string.
     """
     summaries: Dict[str, str] = {}
+    pending = []  # (title, data, cache key) still to summarize
 
     for f in files:
         data = f.read()
@@ -261,8 +872,41 @@ def summarize_uploaded_papers(files) -> Dict[str, str]:
             continue
 
         title = getattr(f, "name", "uploaded_paper.pdf")
-        full_text = _extract_full_text_from_pdf(data)
-        summary = summarize_single_paper_with_bfh_llm(title, full_text)
-        summaries[title] = summary
+        key = SummaryCache.key_for(title, data) if cache is not None else None
+        summary = cache.get(key) if key else None
+        if summary is None:
+            summaries[title] = ""  # placeholder keeps the upload order
+            pending.append((title, data, key))
+        else:
+            summaries[title] = _with_heading(title, summary)
+
+    if pending:
+        # the async BFH client lives on the shared loop
+        results = run_async(_summarize_papers(pending, cache))
+        for (title, _, _), summary in zip(pending, results):
+            summaries[title] = _with_heading(title, summary)
 
     return summaries
+
+
+async def _summarize_papers(pending, cache: Optional[SummaryCache]) -> List[str]:
+    sem = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    async def _summarize_one(title: str, data: bytes, key: Optional[str]) -> str:
+        # all PDFs are parsed in parallel right away, in the process pool
+        # read only about as many pages as the token budget can take
+        max_chars = int(_paper_text_budget(title) * CHARS_PER_TOKEN)
+        full_text = await loop.run_in_executor(
+            _pdf_pool(), extract_full_text, data, max_chars
+        )
+        async with sem:
+            summary = await asummarize_single_paper_with_bfh_llm(title, full_text)
+        if key:
+            # cached as soon as it is done, even if another paper fails
+            cache.set(key, summary)
+        return summary
+
+    return list(
+        await asyncio.gather(*(_summarize_one(*job) for job in pending))
+    )
@@ -1,4 +1,5 @@
 import os
+import glob
 
 # Parameter
 input_folder = "data/text"
@@ -11,11 +12,14 @@ os.makedirs(output_folder, exist_ok=True)
 
 def split_into_chunks(text, chunk_size, overlap):
     words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = words[i:i + chunk_size]
-        chunks.append(" ".join(chunk))
-    return chunks
+    if not words:
+        return []
+    step = chunk_size - overlap
+    # Ein neuer Chunk beginnt nur, solange der vorige das Textende nicht
+    # erreicht hat; sonst entstünde ein Rest-Chunk, der komplett in der
+    # Überlappung des vorigen liegt.
+    starts = range(0, max(len(words) - overlap, 1), step)
+    return [" ".join(words[start:start + chunk_size]) for start in starts]
 
 # Alle Textdateien durchgehen
 for filename in os.listdir(input_folder):
@@ -27,6 +31,10 @@ for filename in os.listdir(input_folder):
         chunks = split_into_chunks(full_text, chunk_size, overlap)
 
         base_name = filename.replace(".txt", "")
+        # Chunks eines früheren Laufs entfernen, sonst bleiben überzählige
+        # Rest-Chunks liegen, wenn der Text jetzt weniger Chunks ergibt
+        for old_chunk in glob.glob(os.path.join(output_folder, glob.escape(base_name) + "_chunk_*.txt")):
+            os.remove(old_chunk)
         for i, chunk in enumerate(chunks):
             chunk_filename = f"{base_name}_chunk_{i+1:03d}.txt"
             chunk_path = os.path.join(output_folder, chunk_filename)
@@ -1,55 +1,158 @@
 import os
 import uuid
-import json
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson  # schneller als json bei großen Float-Listen
 import requests
+from requests.adapters import HTTPAdapter
 
 # === Konfiguration ===
 CHUNK_DIR = "data/chunks"
-OUTPUT_FILE = "data/embeddings.json"
+# JSON Lines: ein Eintrag pro Zeile, wird beim Einbetten fortlaufend geschrieben
+OUTPUT_FILE = "data/embeddings.jsonl"
+# Hash des Chunk-Texts -> Embedding; bei erneuten Läufen werden nur neue
+# oder geänderte Chunks eingebettet
+CACHE_FILE = "data/embeddings_cache.json"
 MODEL = "nomic-embed-text"
+OLLAMA_URL = "http://localhost:11434"
+# Chunks pro Request an /api/embed
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Batches gleichzeitig; wirkt nur mit OLLAMA_NUM_PARALLEL > 1 auf dem Server
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Sekunden pro Request; Ollama arbeitet parallele Batches oft nacheinander ab,
+# daher wächst der Standard mit Batchgröße und Parallelität
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", str(max(60, BATCH_SIZE * EMBED_CONCURRENCY))))
 
-all_embeddings = []
 
-# === Embedding-Funktion via Ollama ===
+# === Eine Session für alle Requests (Keep-Alive statt neuer Verbindung) ===
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=EMBED_CONCURRENCY, max_retries=3))
+
+# === Einzel-Embedding (Fallback, alter Endpoint) ===
+# /api/embeddings liefert ungenormte Vektoren; sie werden hier auf Länge 1
+# gebracht, damit die Datei nur ein Vektorformat enthält (wie /api/embed).
 def get_embedding(text):
-    response = requests.post("http://localhost:11434/api/embeddings", json={
-        "model": MODEL,
-        "prompt": text
-    })
+    try:
+        response = session.post(f"{OLLAMA_URL}/api/embeddings", json={
+            "model": MODEL,
+            "prompt": text
+        }, timeout=EMBED_TIMEOUT)
+    except requests.RequestException as e:
+        # Chunk fehlt in diesem Lauf und wird beim nächsten nachgeholt
+        print("Fehler bei Embedding:", e)
+        return None
     if response.status_code == 200:
-        return response.json()["embedding"]
+        vec = np.asarray(response.json()["embedding"], dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return (vec / norm).tolist() if norm else None
     else:
         print("Fehler bei Embedding:", response.text)
         return None
 
-# === Alle Chunks verarbeiten ===
+# === Batch-Embedding via /api/embed (ein Request pro Batch) ===
+# /api/embed liefert normierte Vektoren, wie bei den Frage-Embeddings der App.
+def get_embeddings_batch(texts):
+    try:
+        response = session.post(f"{OLLAMA_URL}/api/embed", json={
+            "model": MODEL,
+            "input": texts
+        }, timeout=EMBED_TIMEOUT)
+    except requests.RequestException as e:
+        # Timeout / Verbindungsfehler: wie bei einer Fehlerantwort einzeln weiter
+        print("Batch-Embedding fehlgeschlagen, einzeln weiter:", e)
+        return [get_embedding(text) for text in texts]
+    embeddings = response.json().get("embeddings") if response.status_code == 200 else None
+    if embeddings and len(embeddings) == len(texts):
+        return embeddings
+    # ältere Ollama-Versionen ohne /api/embed: einzeln einbetten
+    print("Batch-Embedding fehlgeschlagen, einzeln weiter:", response.status_code)
+    return [get_embedding(text) for text in texts]
+
+# === Alle Chunks einlesen ===
+chunks = []
 for filename in sorted(os.listdir(CHUNK_DIR)):
     if not filename.endswith(".txt"):
         continue
 
     filepath = os.path.join(CHUNK_DIR, filename)
     with open(filepath, "r", encoding="utf-8") as f:
-        text = f.read()
+        chunks.append((filename, f.read()))
 
-    embedding = get_embedding(text)
-    if not embedding:
-        continue
+# === Kompakte Speicherung: float16, base64-kodiert ===
+# ~4 Zeichen pro Dimension statt ~20 als JSON-Float; für die Suche reicht
+# die Genauigkeit (normierte Vektoren), der Import rechnet auf float32 um.
+def encode_f16(vec):
+    return base64.b64encode(np.asarray(vec, dtype="<f2").tobytes()).decode("ascii")
+
+# === Embedding-Cache laden ===
+def chunk_hash(text):
+    # Modell gehört zum Schlüssel: ein anderes Modell braucht neue Vektoren
+    return hashlib.blake2b(f"{MODEL}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+try:
+    with open(CACHE_FILE, "rb") as f:
+        cache = orjson.loads(f.read())
+except (OSError, ValueError):
+    cache = {}
+# Caches älterer Läufe enthalten Float-Listen
+cache = {h: e if isinstance(e, str) else encode_f16(e) for h, e in cache.items()}
+
+# === Nur neue Texte einbetten (identische Chunks nur einmal) ===
+hashes = [chunk_hash(text) for _, text in chunks]
+live = set(hashes)
+
+# Nach jedem Batch gespeichert (atomar via os.replace), damit ein
+# abgebrochener Lauf beim nächsten Start dort weitermacht
+def save_cache():
+    tmp = f"{CACHE_FILE}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps({h: e for h, e in cache.items() if h in live}))
+    os.replace(tmp, CACHE_FILE)
+
+todo = {}
+for h, (_, text) in zip(hashes, chunks):
+    if h not in cache:
+        todo.setdefault(h, text)
+todo = list(todo.items())
+print(f"{len(chunks)} Chunks, davon {len(todo)} neu einzubetten")
 
-    quelle, chunk_id = filename.replace(".txt", "").split("_chunk_")
+batches = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), BATCH_SIZE)]
+done = 0
+try:
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+        results = pool.map(lambda b: get_embeddings_batch([text for _, text in b]), batches)
+        for batch, embeddings in zip(batches, results):
+            for (h, _), embedding in zip(batch, embeddings):
+                if embedding:
+                    cache[h] = encode_f16(embedding)
+            save_cache()
+            done += len(batch)
+            print(f"Eingebettet: {done}/{len(todo)} Chunks")
+finally:
+    # auch bei Abbruch (z. B. Strg+C) bleibt das bisher Eingebettete erhalten
+    save_cache()
 
-    all_embeddings.append({
-        "id": str(uuid.uuid4()),
-        "text": text,
-        "quelle": quelle,
-        "chunk_id": chunk_id,
-        "filename": filename,
-        "embedding": embedding
-    })
+# === Einträge zeilenweise schreiben (keine Gesamtliste im Speicher) ===
+written = 0
+with open(OUTPUT_FILE, "wb") as out:
+    for h, (filename, text) in zip(hashes, chunks):
+        embedding = cache.get(h)
+        if not embedding:
+            continue
 
-    print(f"Gespeichert: {filename}")
+        quelle, chunk_id = filename.replace(".txt", "").split("_chunk_")
 
-# === JSON-Datei schreiben ===
-with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-    json.dump(all_embeddings, f, ensure_ascii=False, indent=2)
+        record = {
+            "id": str(uuid.uuid4()),
+            "text": text,
+            "quelle": quelle,
+            "chunk_id": chunk_id,
+            "filename": filename,
+            "embedding_f16": embedding
+        }
+        out.write(orjson.dumps(record) + b"\n")
+        written += 1
 
-print(f"\n Alle Embeddings gespeichert in {OUTPUT_FILE}")
+print(f"\n {written} Embeddings gespeichert in {OUTPUT_FILE}")
@@ -1,10 +1,31 @@
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import fitz  # PyMuPDF
 
 
+def _extract_one(pdf_path: Path, output_folder: Path) -> str:
+    # PDF öffnen und Text extrahieren
+    doc = fitz.open(str(pdf_path))
+    try:
+        # Seiten sammeln und einmal zusammenfügen (statt += pro Seite)
+        parts = []
+        for page_num, page in enumerate(doc, start=1):
+            parts.append(f"\n--- Seite {page_num} ---\n")
+            parts.append(page.get_text("text", flags=fitz.TEXTFLAGS_TEXT))
+    finally:
+        doc.close()
+    full_text = "".join(parts)
+
+    # Text als .txt speichern
+    txt_path = output_folder / f"{pdf_path.stem}.txt"
+    with open(txt_path, "w", encoding="utf-8") as f:
+        f.write(full_text)
+    return pdf_path.name
+
+
 def main() -> int:
     # Pfade relativ zur Skriptdatei (nicht CWD) auflösen
     script_dir = Path(__file__).resolve().parent
@@ -22,24 +43,11 @@ def main() -> int:
         print(f"Keine PDFs im Ordner gefunden: {input_folder}")
         return 0
 
-    # Alle PDFs im Input-Ordner durchgehen
-    for pdf_path in pdf_files:
-        print(f"Bearbeite: {pdf_path.name}")
-
-        # PDF öffnen und Text extrahieren
-        doc = fitz.open(str(pdf_path))
-        try:
-            full_text = ""
-            for page_num, page in enumerate(doc, start=1):
-                full_text += f"\n--- Seite {page_num} ---\n"
-                full_text += page.get_text()
-        finally:
-            doc.close()
-
-        # Text als .txt speichern
-        txt_path = output_folder / f"{pdf_path.stem}.txt"
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(full_text)
+    # PDFs parallel verarbeiten (ein Prozess pro CPU-Kern)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        outputs = [output_folder] * len(pdf_files)
+        for name in pool.map(_extract_one, pdf_files, outputs):
+            print(f"Bearbeitet: {name}")
 
     print(f"Alle Texte wurden extrahiert und gespeichert in: {output_folder}")
     return 0
@@ -1,11 +1,18 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import chromadb
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
+# === Eine Session für Ollama und Together (Keep-Alive, Connection-Pool) ===
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=3)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
 
 # === Together.ai Setup ===
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
@@ -20,7 +27,7 @@ if not frage:
 
 # === Embedding mit nomic-embed-text via Ollama ===
 print("Erzeuge Embedding für die Frage...")
-embed_response = requests.post("http://localhost:11434/api/embeddings", json={
+embed_response = session.post("http://localhost:11434/api/embeddings", json={
     "model": "nomic-embed-text",
     "prompt": frage
 })
@@ -64,7 +71,7 @@ Antwort:"""
 
 # === Anfrage an Mixtral senden ===
 print("Anfrage wird an Together.ai gesendet...")
-response = requests.post(
+response = session.post(
     "https://api.together.xyz/v1/completions",
     headers={"Authorization": f"Bearer {TOGETHER_API_KEY}"},
     json={
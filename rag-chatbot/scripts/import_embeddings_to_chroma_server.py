@@ -1,26 +1,75 @@
-import json
+import base64
+import os
+import sys
+
 import chromadb
+import numpy as np
+import orjson  # schneller als json bei großen Float-Listen
+
+# kb_config liegt eine Ebene höher (neben rag_tools.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kb_config import KB_HNSW_METADATA  # noqa: E402
 
 # === Mit dem Chroma-Server verbinden ===
 client = chromadb.HttpClient(host="chroma", port=8000)
-collection = client.get_or_create_collection(name="gesetzestexte")
+
+# === Collection neu anlegen ===
+# HNSW-Parameter lassen sich nach dem Anlegen nicht mehr ändern, daher wird
+# eine bestehende Collection ersetzt (das verhindert auch doppelte Einträge).
+# Werte aus kb_config.py, dieselben wie in der App (Begründung siehe dort).
+try:
+    client.delete_collection(name="gesetzestexte")
+except Exception:
+    pass  # noch nicht vorhanden
+collection = client.create_collection(name="gesetzestexte", metadata=KB_HNSW_METADATA)
 
 # === Embeddings laden ===
-with open("data/embeddings.json", "r", encoding="utf-8") as f:
-    data = json.load(f)
+# data/embeddings.jsonl (aktuelles Format) wird zeilenweise gelesen;
+# ältere Stände mit data/embeddings.json funktionieren weiterhin.
+def read_entries():
+    if os.path.exists("data/embeddings.jsonl"):
+        with open("data/embeddings.jsonl", "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+    else:
+        with open("data/embeddings.json", "rb") as f:
+            yield from orjson.loads(f.read())
 
-# === In Chroma importieren ===
-for entry in data:
+# float16 (base64) aus create_embeddings_json.py, ältere Dateien mit Float-Liste
+def to_vector(entry):
+    if "embedding_f16" in entry:
+        raw = base64.b64decode(entry["embedding_f16"])
+        return np.frombuffer(raw, dtype="<f2").astype(np.float32)
+    return np.asarray(entry["embedding"], dtype=np.float32)
+
+# === In Chroma importieren (batchweise statt ein Request pro Eintrag) ===
+BATCH_SIZE = 256
+
+def add_batch(batch):
     collection.add(
-        ids=[entry["id"]],
-        documents=[entry["text"]],
-        embeddings=[entry["embedding"]],
+        ids=[e["id"] for e in batch],
+        documents=[e["text"] for e in batch],
+        embeddings=np.vstack([to_vector(e) for e in batch]),
         metadatas=[{
-            "filename": entry["filename"],
-            "chunk_id": entry["chunk_id"],
-            "quelle": entry["quelle"]
-        }]
+            "filename": e["filename"],
+            "chunk_id": e["chunk_id"],
+            "quelle": e["quelle"]
+        } for e in batch]
     )
-    print(f"✅ Importiert: {entry['filename']}")
 
-print(f"\n Import abgeschlossen: {len(data)} Embeddings in Chroma (Server-Modus)")
+total = 0
+batch = []
+for entry in read_entries():
+    batch.append(entry)
+    if len(batch) == BATCH_SIZE:
+        add_batch(batch)
+        total += len(batch)
+        batch = []
+        print(f"✅ Importiert: {total}")
+if batch:
+    add_batch(batch)
+    total += len(batch)
+    print(f"✅ Importiert: {total}")
+
+print(f"\n Import abgeschlossen: {total} Embeddings in Chroma (Server-Modus)")
@@ -0,0 +1,138 @@
+# semantic_cache.py
+#
+# Small in-process cache for the label-only classifier calls (router,
+# methods task). Exact hits are looked up by normalised key; near-duplicate
+# questions are matched by cosine similarity of their embeddings.
+
+import atexit
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+_WS_RE = re.compile(r"\s+")
+
+CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".cache")
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase and collapse whitespace, so trivial edits share a key."""
+    return _WS_RE.sub(" ", text).strip().lower()
+
+
+class SemanticCache:
+    """
+    LRU map of key -> label, with an optional embedding per entry.
+
+    `scope` partitions fuzzy matches (e.g. by mode/persona), so a similar
+    question asked under different settings is not served a foreign label.
+    Entries are written to `path` (JSON) at interpreter exit and loaded back
+    on construction.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 2048,
+        threshold: float = 0.92,
+        path: Optional[str] = None,
+    ):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.path = path
+        self._lock = threading.Lock()
+        # key -> {"label": str, "scope": str, "vec": List[float] | None}
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        # (scope -> (unit-vector matrix, labels)); rebuilt after writes
+        self._index: Optional[Dict[str, tuple]] = None
+
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry["label"]
+
+    def get_similar(self, vec: List[float], scope: str = "") -> Optional[str]:
+        """Label of the most similar stored entry in `scope`, if close enough."""
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            matrix, labels = self._index.get(scope, (None, None))
+        if matrix is None:
+            return None
+        q = _unit(vec)
+        if q is None or q.shape[0] != matrix.shape[1]:
+            return None
+        sims = matrix @ q
+        best = int(np.argmax(sims))
+        return labels[best] if sims[best] >= self.threshold else None
+
+    def put(
+        self,
+        key: str,
+        label: str,
+        vec: Optional[List[float]] = None,
+        scope: str = "",
+    ) -> None:
+        with self._lock:
+            self._entries[key] = {"label": label, "scope": scope, "vec": vec}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._index = None
+
+    def _build_index(self) -> Dict[str, tuple]:
+        grouped: Dict[str, tuple] = {}
+        for entry in self._entries.values():
+            u = _unit(entry["vec"]) if entry["vec"] else None
+            if u is None:
+                continue
+            vecs, labels = grouped.setdefault(entry["scope"], ([], []))
+            if vecs and u.shape != vecs[0].shape:
+                continue  # stored under a different embedding model
+            vecs.append(u)
+            labels.append(entry["label"])
+        return {
+            scope: (np.vstack(vecs), labels)
+            for scope, (vecs, labels) in grouped.items()
+        }
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return
+        for key, entry in data.items():
+            self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            data = dict(self._entries)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not save semantic cache {self.path}: {e}")
+
+
+def _unit(vec) -> Optional[np.ndarray]:
+    arr = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(arr))
+    return arr / norm if norm else None